@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import atexit
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ["CACHE_DIR"] = tempfile.mkdtemp(prefix="lingobot-bench-")
+atexit.register(shutil.rmtree, os.environ["CACHE_DIR"], ignore_errors=True)
+os.environ["WIKTIONARY_INDEX"] = os.path.join(os.environ["CACHE_DIR"], "missing.idx")
+
+import main
+from discord import app_commands
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+with open('JSON/welcome.json', mode='r', encoding='utf-8') as file:
+    WELCOME = json.load(file)
+with open('JSON/immersion.json', mode='r', encoding='utf-8') as file:
+    REPLIES = [value['reply'] for value in json.load(file).values()]
+with open('testOutput/testOutput.json', mode='r', encoding='utf-8') as file:
+    DUMP = json.load(file)
+
+
+class Channel:
+    def __init__(self, category_id):
+        self.id = category_id
+        self.category_id = category_id
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+        return SimpleNamespace(id=self.sent)
+
+
+class Response:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+    async def defer(self, *args, **kwargs):
+        pass
+
+
+class Followup:
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class Interaction:
+    ids = itertools.count(1)
+
+    def __init__(self):
+        self.id = next(self.ids)
+        self.response = Response()
+        self.followup = Followup()
+
+    async def delete_original_response(self):
+        pass
+
+
+class StubParser:
+    """Offline stand-in for WiktionaryParser that answers from testOutput/testOutput.json."""
+
+    def fetch(self, word, language=None):
+        for dump_language, words in DUMP.items():
+            if dump_language.lower() == (language or "english").lower() and word in words:
+                return words[word]
+        return []
+
+
+def stub_network():
+    main.wiktionary_parser = StubParser
+    main.IMAGE_SEARCH.first = lambda query: f"https://example.org/{query}.png"
+
+
+def corpus(rng, size):
+    sentences = list(WELCOME.values()) + REPLIES
+    return [" ".join(rng.sample(sentences, rng.randint(1, 3))) for _ in range(size)]
+
+
+def scenarios(rng, size):
+    texts = corpus(rng, size)
+    han = [text for text in texts if main.HAN.search(text)] or ["我们今天去图书馆看书"]
+    cyrillic = [text for text in texts if main.dominant_script(text) == "cyrillic"] or [WELCOME["RU"]]
+    categories = list(main.IMMERSION.policies)
+    words = [(word, language) for language, entries in DUMP.items() for word in entries] + [("qwzzx", "english")]
+    style = app_commands.Choice(name="Diacritical tone marking.", value="diacritical")
+
+    ids = itertools.count(1)
+
+    def message(text):
+        return SimpleNamespace(id=next(ids), content=text, author=SimpleNamespace(bot=False, id=rng.randrange(200)),
+                               channel=Channel(rng.choice(categories)))
+
+    def unfurl(text):
+        edited = message(text)
+        return main.on_message_edit(edited, edited)
+
+    return {
+        "on_message": [lambda text=text: main.on_message(message(text)) for text in texts],
+        "on_message_edit": [lambda text=text: unfurl(text) for text in texts],
+        "convert": [lambda text=text: main.convert.callback(Interaction(), text) for text in han],
+        "trans_zh": [lambda text=text: main.trans_zh.callback(Interaction(), text, style) for text in han],
+        "trans_cyrillic": [lambda text=text: main.trans_cyrillic.callback(Interaction(), text) for text in cyrillic],
+        "wiktionary": [lambda entry=entry: main.wiktionary.callback(Interaction(), *entry)
+                       for entry in rng.choices(words, k=size)],
+    }
+
+
+async def timed(call):
+    start = time.perf_counter()
+    await call()
+    return time.perf_counter() - start
+
+
+async def run(calls, concurrency):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(0, len(calls), concurrency):
+        latencies += await asyncio.gather(*(timed(call) for call in calls[i:i + concurrency]))
+    return time.perf_counter() - start, latencies
+
+
+async def allocations(calls, concurrency):
+    tracemalloc.start()
+    await run(calls, concurrency)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1] if len(values) > 1 else values[0]
+
+
+async def measure(size, concurrency, seed):
+    stub_network()
+    main.prewarm()
+    results = {}
+    for name, calls in scenarios(random.Random(seed), size).items():
+        await run(calls[:concurrency], concurrency)
+        elapsed, latencies = await run(calls, concurrency)
+        results[name] = {
+            "ops_per_s": len(calls) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1e3,
+            "p95_ms": percentile(latencies, 95) * 1e3,
+            "p99_ms": percentile(latencies, 99) * 1e3,
+            "peak_alloc_kib": await allocations(calls, concurrency) / 1024,
+        }
+    return results
+
+
+def report(results, baseline, tolerance):
+    regressions = []
+    print(f"{'path':<15}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KiB':>10}  vs baseline p95")
+    for name, result in results.items():
+        line = (f"{name:<15}{result['ops_per_s']:>10.0f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                f"{result['p99_ms']:>10.2f}{result['peak_alloc_kib']:>10.0f}")
+        if name in baseline:
+            change = result["p95_ms"] / baseline[name]["p95_ms"] - 1
+            line += f"  {change:+.0%}"
+            if change > tolerance:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a synthetic multilingual workload through the bot.")
+    parser.add_argument("--size", type=int, default=500, help="Calls per path.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Calls in flight at once, like a chat burst.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 slowdown against the baseline.")
+    parser.add_argument("--save", action="store_true", help=f"Write the results to {BASELINE}.")
+    args = parser.parse_args()
+
+    results = asyncio.run(measure(args.size, args.concurrency, args.seed))
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, mode='r', encoding='utf-8') as file:
+            baseline = json.load(file)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(BASELINE, mode='w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    sys.exit(1 if regressions and not args.save else 0)
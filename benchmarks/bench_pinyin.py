@@ -0,0 +1,32 @@
+import os
+import sys
+import timeit
+import unicodedata
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from main import PINYIN, remove_pinyin
+
+
+def remove_pinyin_replace(input_string):
+    input_string = ''.join(c for c in unicodedata.normalize('NFD', input_string) if unicodedata.category(c) != 'Mn')
+    for syllable in PINYIN:
+        input_string = input_string.replace(syllable, '')
+    return input_string
+
+
+MESSAGES = {
+    "short": "我今天很高兴 wǒ jīntiān hěn gāoxìng",
+    "mixed": "我们明天去北京吗？ women mingtian qu Beijing ma? 我觉得可以 wo3 jue2de ke3yi3, nv3hai2 lv4se4 " * 20,
+    "long": "昨天我和朋友一起去了图书馆看书，zuótiān wǒ hé péngyou yìqǐ qùle túshūguǎn kànshū, then we got coffee. " * 200,
+}
+
+
+if __name__ == "__main__":
+    for name, message in MESSAGES.items():
+        number = max(1, 20000 // len(message))
+        for label, function in (("str.replace", remove_pinyin_replace), ("segmenter", remove_pinyin)):
+            seconds = min(timeit.repeat(lambda: function(message), number=number, repeat=5)) / number
+            print(f"{name:>6} ({len(message):>6} chars) {label:>11}: {seconds * 1e6:10.1f} µs")
@@ -1,94 +1,2107 @@
+import asyncio
+import copy
+import logging
+import queue
+import io
+import html
+import importlib
+import csv
+import gzip
 import discord
 import json
 import random
-import langdetect
 import pinyin
 import os
+import sys
 import validators
 import unicodedata
+import threading
+import sqlite3
+import time
+import mmap
+import struct
+import zlib
+import hashlib
+import heapq
+import bisect
+import difflib
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from functools import lru_cache, partial
 from discord import app_commands
-from discord.ext import commands
-from chinese_converter import to_traditional, to_simplified
-from googleapiclient.errors import HttpError
-from lingua import Language, LanguageDetectorBuilder
-from wiktionaryparser import WiktionaryParser
-from google_images_search import GoogleImagesSearch
-from unidecode import unidecode
+from discord.ext import commands, tasks
+from chinese_converter import most_common_word, simp_to_trad, trad_to_simp
+from lingua import IsoCode639_1, Language, LanguageDetectorBuilder
 import re
+import requests
+from aiohttp import web
 
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 GCS_DEVELOPER_KEY = os.environ.get("GCS_DEVELOPER_KEY")
 GCS_CX = os.environ.get("GCS_CX")
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+STAFF_ROLE = os.environ.get("STAFF_ROLE", "Staff")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+SHARDS = os.environ.get("SHARDS", "")
+MEMBER_CACHE = os.environ.get("MEMBER_CACHE", "none")
+CHUNK_GUILDS = os.environ.get("CHUNK_GUILDS", "0") == "1"
+
+log = logging.getLogger("lingobot")
 
-with open('JSON/immersion.json', mode='r', encoding='utf-8') as file:
-    IMMERSION_CATEGORIES = {int(key): value for (key, value) in json.load(file).items()}
 with open('JSON/welcome.json', mode='r', encoding='utf-8') as file:
     WELCOME_MSGS = list(json.load(file).values())
 with open('JSON/wod.json', mode='r', encoding='utf-8') as file:
     WOD = json.load(file)
     LANGS = [app_commands.Choice(name=f"{n} | {WOD[n]['name']}", value=n) for n in WOD]
-PINYIN = ['shuang', 'chuang', 'diang', 'cheng', 'liang', 'jiang', 'niang', 'jiong', 'qiang', 'shuai', 'xiang', 'xiong',
-          'qiong', 'huang', 'shang', 'chuan', 'guang', 'chuai', 'chang', 'kuang', 'chong', 'shong', 'shuan', 'sheng',
-          'heng', 'tong', 'biao', 'quan', 'guan', 'fang', 'tian', 'weng', 'shai', 'bian', 'dang', 'gong', 'diao',
-          'dong', 'mian', 'reng', 'qing', 'kuan', 'geng', 'ning', 'chuo', 'kuai', 'hong', 'ting', 'ming', 'song',
-          'ding', 'juan', 'mang', 'shan', 'chou', 'tiao', 'ceng', 'nian', 'kang', 'chun', 'chao', 'beng', 'shei',
-          'duan', 'teng', 'ruan', 'bang', 'miao', 'piao', 'nong', 'xian', 'yuan', 'xuan', 'seng', 'jing', 'neng',
-          'ping', 'shui', 'yong', 'wang', 'gang', 'lang', 'tang', 'chan', 'rang', 'chua', 'huan', 'pang', 'shun',
-          'yang', 'shuo', 'cuan', 'sang', 'dian', 'bing', 'pian', 'leng', 'shou', 'luan', 'chui', 'shen', 'nuan',
-          'shua', 'peng', 'long', 'tuan', 'shao', 'feng', 'liao', 'chen', 'cong', 'niao', 'guai', 'meng', 'xiao',
-          'ling', 'lian', 'chai', 'suan', 'qian', 'kong', 'xing', 'huai', 'ying', 'deng', 'hang', 'jiao', 'nang',
-          'jian', 'keng', 'cang', 'rong', 'qiao', 'nei', 'dan', 'run', 'duo', 'mei', 'cui', 'lün', 'tui', 'lin', 'wen',
-          'qin', 'nen', 'niu', 'hao', 'gei', 'wan', 'nin', 'dou', 'cun', 'nüe', 'nun', 'pei', 'man', 'xia', 'lia',
-          'min', 'lan', 'gui', 'hua', 'sui', 'lao', 'shi', 'sei', 'qie', 'diu', 'mai', 'tun', 'jin', 'tan', 'wai',
-          'kao', 'ban', 'hai', 'hen', 'qia', 'ben', 'sao', 'hui', 'gan', 'pai', 'suo', 'ren', 'kua', 'hun', 'tie',
-          'shu', 'cuo', 'rui', 'fei', 'she', 'kan', 'xiu', 'che', 'pan', 'nan', 'sai', 'cha', 'zun', 'lie', 'rao',
-          'nai', 'tou', 'luo', 'liu', 'xun', 'mao', 'dun', 'dai', 'cou', 'nao', 'gou', 'nou', 'ran', 'san', 'jue',
-          'fou', 'kai', 'gao', 'sha', 'die', 'gun', 'yun', 'kun', 'nia', 'yue', 'miu', 'yan', 'bin', 'cai', 'lei',
-          'men', 'gai', 'pin', 'guo', 'tuo', 'kuo', 'sun', 'nie', 'qiu', 'sen', 'tao', 'yin', 'pen', 'hei', 'ken',
-          'dao', 'you', 'han', 'xie', 'nuo', 'den', 'xin', 'bei', 'gua', 'ang', 'kou', 'cen', 'que', 'hou', 'bao',
-          'kui', 'dui', 'huo', 'jiu', 'chu', 'bai', 'zuo', 'dei', 'cao', 'mou', 'qun', 'chi', 'lüe', 'pao', 'tai',
-          'yao', 'ruo', 'sou', 'lai', 'lun', 'fen', 'jun', 'pou', 'gen', 'mie', 'wei', 'fan', 'jia', 'bie', 'rou',
-          'can', 'pie', 'lou', 'jie', 'xue', 'ge', 'di', 'da', 'ao', 'ne', 'na', 'an', 'la', 'ha', 'ku', 'pa', 're',
-          'ju', 'yu', 'ye', 'er', 'nü', 'gu', 'fo', 'qi', 'du', 'mo', 'bu', 'ei', 'si', 'ri', 'ca', 'ka', 'de', 'ya',
-          'yi', 'lü', 'fu', 'me', 'se', 'bi', 'po', 'lo', 'ga', 'wa', 'hu', 'ke', 'su', 'ma', 'ni', 'ru', 'bo', 'ci',
-          'ai', 'qu', 'ji', 'ce', 'tu', 'fa', 'xu', 'cu', 'mu', 'ba', 'ou', 'pu', 'lu', 'he', 'nu', 'le', 'li', 'sa',
-          'wu', 'xi', 'en', 'te', 'mi', 'pi', 'wo', 'ti', 'ta', 'e', 'a']
-
-
-def match_lang(text, iso_lang):
-    # detector = LanguageDetectorBuilder.from_all_languages().build()
-    result_a = langdetect.detect(text)
-    # result_b = detector.detect_language_of(text).iso_code_639_1.name.lower()
-    print(result_a)
-    for each in iso_lang:
-        if result_a == each:
-            return True
-    return False
+PINYIN = ['shuang', 'chuang', 'zhuang', 'diang', 'cheng', 'liang', 'jiang', 'niang', 'jiong', 'qiang', 'shuai', 'xiang',
+          'xiong', 'qiong', 'huang', 'shang', 'chuan', 'guang', 'chuai', 'chang', 'kuang', 'chong', 'shong', 'shuan',
+          'sheng', 'zhuai', 'zhuan', 'zheng', 'zhang', 'zhong', 'heng', 'tong', 'biao', 'quan', 'guan', 'fang', 'tian',
+          'weng', 'shai', 'bian', 'dang', 'gong', 'diao', 'dong', 'mian', 'reng', 'qing', 'kuan', 'geng', 'ning',
+          'chuo', 'kuai', 'hong', 'ting', 'ming', 'song', 'ding', 'juan', 'mang', 'shan', 'chou', 'tiao', 'ceng',
+          'nian', 'kang', 'chun', 'chao', 'beng', 'shei', 'duan', 'teng', 'ruan', 'bang', 'miao', 'piao', 'nong',
+          'xian', 'yuan', 'xuan', 'seng', 'jing', 'neng', 'ping', 'shui', 'yong', 'wang', 'gang', 'lang', 'tang',
+          'chan', 'rang', 'chua', 'huan', 'pang', 'shun', 'yang', 'shuo', 'cuan', 'sang', 'dian', 'bing', 'pian',
+          'leng', 'shou', 'luan', 'chui', 'shen', 'nuan', 'shua', 'peng', 'long', 'tuan', 'shao', 'feng', 'liao',
+          'chen', 'cong', 'niao', 'guai', 'meng', 'xiao', 'ling', 'lian', 'chai', 'suan', 'qian', 'kong', 'xing',
+          'huai', 'ying', 'deng', 'hang', 'jiao', 'nang', 'jian', 'keng', 'cang', 'rong', 'qiao', 'zhai', 'zhan',
+          'zhao', 'zhen', 'zhou', 'zhua', 'zhui', 'zhun', 'zhuo', 'zang', 'zeng', 'zong', 'zuan', 'nei', 'dan', 'run',
+          'duo', 'mei', 'cui', 'lün', 'tui', 'lin', 'wen', 'qin', 'nen', 'niu', 'hao', 'gei', 'wan', 'nin', 'dou',
+          'cun', 'nüe', 'nun', 'pei', 'man', 'xia', 'lia', 'min', 'lan', 'gui', 'hua', 'sui', 'lao', 'shi', 'sei',
+          'qie', 'diu', 'mai', 'tun', 'jin', 'tan', 'wai', 'kao', 'ban', 'hai', 'hen', 'qia', 'ben', 'sao', 'hui',
+          'gan', 'pai', 'suo', 'ren', 'kua', 'hun', 'tie', 'shu', 'cuo', 'rui', 'fei', 'she', 'kan', 'xiu', 'che',
+          'pan', 'nan', 'sai', 'cha', 'zun', 'lie', 'rao', 'nai', 'tou', 'luo', 'liu', 'xun', 'mao', 'dun', 'dai',
+          'cou', 'nao', 'gou', 'nou', 'ran', 'san', 'jue', 'fou', 'kai', 'gao', 'sha', 'die', 'gun', 'yun', 'kun',
+          'nia', 'yue', 'miu', 'yan', 'bin', 'cai', 'lei', 'men', 'gai', 'pin', 'guo', 'tuo', 'kuo', 'sun', 'nie',
+          'qiu', 'sen', 'tao', 'yin', 'pen', 'hei', 'ken', 'dao', 'you', 'han', 'xie', 'nuo', 'den', 'xin', 'bei',
+          'gua', 'ang', 'kou', 'cen', 'que', 'hou', 'bao', 'kui', 'dui', 'huo', 'jiu', 'chu', 'bai', 'zuo', 'dei',
+          'cao', 'mou', 'qun', 'chi', 'lüe', 'pao', 'tai', 'yao', 'ruo', 'sou', 'lai', 'lun', 'fen', 'jun', 'pou',
+          'gen', 'mie', 'wei', 'fan', 'jia', 'bie', 'rou', 'can', 'pie', 'lou', 'jie', 'xue', 'zai', 'zan', 'zao',
+          'zei', 'zen', 'zha', 'zhe', 'zhi', 'zou', 'zui', 'dia', 'ge', 'di', 'da', 'ao', 'ne', 'na', 'an', 'la', 'ha',
+          'ku', 'pa', 're', 'ju', 'yu', 'ye', 'er', 'nü', 'gu', 'fo', 'qi', 'du', 'mo', 'bu', 'ei', 'si', 'ri', 'ca',
+          'ka', 'de', 'ya', 'yi', 'lü', 'fu', 'me', 'se', 'bi', 'po', 'lo', 'ga', 'wa', 'hu', 'ke', 'su', 'ma', 'ni',
+          'ru', 'bo', 'ci', 'ai', 'qu', 'ji', 'ce', 'tu', 'fa', 'xu', 'cu', 'mu', 'ba', 'ou', 'pu', 'lu', 'he', 'nu',
+          'le', 'li', 'sa', 'wu', 'xi', 'en', 'te', 'mi', 'pi', 'wo', 'ti', 'ta', 'za', 'ze', 'zi', 'zu', 'yo', 'e',
+          'a', 'o']
 
 
-def remove_pinyin(input_string):
-    input_string = ''.join(c for c in unicodedata.normalize('NFD', input_string) if unicodedata.category(c) != 'Mn')
+def pinyin_syllables():
+    syllables = set()
     for syllable in PINYIN:
-        input_string = input_string.replace(syllable, '')
-    return input_string
+        syllables.update(syllable.replace('ü', spelling) for spelling in ('u', 'v', 'u:'))
+    return frozenset(syllables)
+
+
+PINYIN_SYLLABLES = pinyin_syllables()
+PINYIN_MAX_LENGTH = max(len(syllable) for syllable in PINYIN_SYLLABLES)
+PINYIN_WORD = re.compile(r"[A-Za-z0-9:]+")
+NONSPACING_MARKS = {cp: None for cp in range(sys.maxunicode + 1) if unicodedata.category(chr(cp)) == 'Mn'}
+
+
+@lru_cache(maxsize=4096)
+def is_pinyin(word):
+    word = word.lower()
+    reachable = [True] + [False] * len(word)
+    for start in range(len(word)):
+        if not reachable[start]:
+            continue
+        for end in range(start + 1, min(start + PINYIN_MAX_LENGTH, len(word)) + 1):
+            if word[start:end] in PINYIN_SYLLABLES:
+                reachable[end] = True
+                if end < len(word) and word[end] in "12345":
+                    reachable[end + 1] = True
+    return reachable[-1]
+
+
+def remove_pinyin(input_string):
+    input_string = unicodedata.normalize('NFD', input_string).translate(NONSPACING_MARKS)
+    return PINYIN_WORD.sub(lambda match: '' if is_pinyin(match.group()) else match.group(), input_string)
+
+
+PREPROCESSORS = {"pinyin": remove_pinyin}
+
+
+@dataclass(frozen=True)
+class ImmersionPolicy:
+    allowed: frozenset
+    reply: str
+    preprocess: tuple = ()
+    min_words: int = 8
+
+    def prepare(self, text):
+        for step in self.preprocess:
+            text = step(text)
+        return text
+
+
+def load_immersion(path):
+    with open(path, mode='r', encoding='utf-8') as file:
+        data = json.load(file)
+    return {int(key): ImmersionPolicy(allowed=frozenset(value['allowed']),
+                                      reply=value['reply'],
+                                      preprocess=tuple(PREPROCESSORS[step] for step in value.get('preprocess', [])),
+                                      min_words=value.get('min_words', 8))
+            for key, value in data.items()}
+
+
+class ImmersionPolicies:
+    """Category ID -> ImmersionPolicy table, swapped in whole when the JSON file changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+        self.policies = load_immersion(path)
+
+    def get(self, category_id):
+        return self.policies.get(category_id)
+
+    def reload(self):
+        """Whether a changed file was loaded."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            self.policies = load_immersion(self.path)
+            log.info("policies reloaded", extra={"fields": {"path": self.path, "categories": len(self.policies)}})
+            return True
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            log.error("policy reload failed", extra={"fields": {"path": self.path, "error": repr(error)}})
+            return False
+
+
+IMMERSION = ImmersionPolicies('JSON/immersion.json')
+
+
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+def hit_ratio(hits, misses):
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+class Metrics:
+    """Thread-safe counters, timings and gauges, rendered for /botstats and in Prometheus text format."""
+
+    def __init__(self, prefix="lingobot"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(lambda: [0, 0.0, 0.0])
+        self.gauges = {}
+
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timing = self.timings[name]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timings = {name: tuple(timing) for name, timing in self.timings.items()}
+        return counters, timings, {name: function() for name, function in self.gauges.items()}
+
+    def prometheus(self):
+        counters, timings, gauges = self.snapshot()
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            lines.append(f"{self.prefix}_{name}_total{{{label_text}}} {value}" if labels
+                         else f"{self.prefix}_{name}_total {value}")
+        for name, (count, total, longest) in sorted(timings.items()):
+            lines.append(f"{self.prefix}_{name}_seconds_count {count}")
+            lines.append(f"{self.prefix}_{name}_seconds_sum {total:.6f}")
+            lines.append(f"{self.prefix}_{name}_seconds_max {longest:.6f}")
+        for name, value in sorted(gauges.items()):
+            lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage(), **getattr(record, "fields", {})}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `rate` records per message template every `per` seconds."""
+
+    def __init__(self, rate=20, per=60):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.windows = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        key = (record.name, record.msg)
+        start, seen = self.windows.get(key, (now, 0))
+        if now - start > self.per:
+            start, seen = now, 0
+        self.windows[key] = (start, seen + 1)
+        return seen < self.rate
+
+
+class RecordQueueHandler(QueueHandler):
+    """Queues records with their arguments merged but exc_info kept, so JsonFormatter can fill in "exception"."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging():
+    """Routes every log record through a queue so formatting and writing happen off the event loop."""
+    records = queue.SimpleQueue()
+    handler = RecordQueueHandler(records)
+    handler.addFilter(RateLimitFilter())
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter())
+    listener = QueueListener(records, output)
+    listener.start()
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler])
+    return listener
+
+
+class Lazy:
+    """Builds a value once, on first use or when warmed in the background, from whichever thread gets there first."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.value = MISSING
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.value is MISSING:
+            with self.lock:
+                if self.value is MISSING:
+                    self.value = self.factory()
+        return self.value
+
+    def reset(self):
+        with self.lock:
+            self.value = MISSING
+
+
+def detector_languages():
+    allowed = {code.split('-')[0] for policy in IMMERSION.policies.values() for code in policy.allowed}
+    languages = []
+    for code in sorted(allowed | {code.lower() for code in WOD}):
+        try:
+            languages.append(IsoCode639_1.from_str(code))
+        except ValueError:
+            if code in allowed:
+                log.warning("allowed language unknown to the detector", extra={"fields": {"code": code}})
+    return languages
+
+
+DETECTOR_LANGUAGES = set(detector_languages())
+DETECTOR = Lazy(lambda: LanguageDetectorBuilder.from_iso_codes_639_1(*DETECTOR_LANGUAGES)
+                .with_preloaded_language_models().build())
+
+
+def refresh_detector():
+    """Rebuilds the detector, on its own thread, when the policies allow a language it was not built for."""
+    added = set(detector_languages()) - DETECTOR_LANGUAGES
+    if not added:
+        return
+    DETECTOR_LANGUAGES.update(added)
+    DETECTOR.reset()
+    DETECTIONS.clear()
+    DETECTION.executor.submit(DETECTOR.get)
+    log.info("detector rebuilt", extra={"fields": {"added": sorted(language.name.lower() for language in added)}})
+
+
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', text).lower().split())
+
+
+DETECTIONS = LRUCache(4096)
+
+
+def compute_lang(text):
+    with METRICS.timer("detection"):
+        language = DETECTOR.get().detect_language_of(text)
+    result = language.iso_code_639_1.name.lower() if language else None
+    DETECTIONS.put(text, result)
+    return result
+
+
+def detect_langs(texts):
+    # One call per text rather than detect_languages_in_parallel_of, so the GIL is handed back between texts.
+    return [compute_lang(text) for text in texts]
+
+
+class DetectionBatcher:
+    """Collects texts for a few milliseconds and detects them together on a worker thread."""
+
+    def __init__(self, delay=0.005, max_batch=64):
+        self.delay = delay
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detection")
+        self.pending = {}
+        self.timer = None
+
+    async def detect(self, text):
+        text = normalize_text(text)
+        result = DETECTIONS.get(text, MISSING)
+        if result is not MISSING:
+            return result
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(text, []).append(future)
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.delay, self.flush)
+        return await future
+
+    async def match(self, text, iso_lang):
+        return await self.detect(text) in iso_lang
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            METRICS.count("detection_batches")
+            task = asyncio.get_running_loop().run_in_executor(self.executor, detect_langs, list(batch))
+            task.add_done_callback(partial(self.resolve, batch))
+
+    @staticmethod
+    def resolve(batch, task):
+        error = asyncio.CancelledError() if task.cancelled() else task.exception()
+        results = [None] * len(batch) if error else task.result()
+        for futures, result in zip(batch.values(), results):
+            for future in futures:
+                if future.done():
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+DETECTION = DetectionBatcher()
+METRICS.gauge("detection_cache_hit_ratio", lambda: hit_ratio(DETECTIONS.hits, DETECTIONS.misses))
+METRICS.gauge("detection_queue_depth", lambda: len(DETECTION.pending) + DETECTION.executor._work_queue.qsize())
+
+
+class ChineseConverter:
+    """chinese_converter's tables compiled once: a str.translate table for every unambiguous character, and a cached
+    bigram decision for the simplified characters that have several traditional forms."""
+
+    def __init__(self, memo_size=1024, memo_length=2000):
+        self.simplified_table = trad_to_simp
+        self.traditional_table = str.maketrans({s: t[0] for s, t in simp_to_trad.items() if len(t) == 1})
+        self.ambiguous = {s: t for s, t in simp_to_trad.items() if len(t) > 1}
+        self.ambiguous_pattern = re.compile("[" + "".join(map(re.escape, self.ambiguous)) + "]")
+        self.memo = LRUCache(memo_size)
+        self.memo_length = memo_length
+        self.choose = lru_cache(maxsize=65536)(self.choose)
+
+    def choose(self, char, prev_char, next_char):
+        return most_common_word(self.ambiguous[char], prev_char, next_char)
+
+    def convert(self, text, direction):
+        with METRICS.timer("conversion"):
+            return self.memoized(text, direction)
+
+    def memoized(self, text, direction):
+        if len(text) > self.memo_length:
+            return self.simplify(text) if direction == "simplified" else self.traditionalize(text)
+        result = self.memo.get((direction, text), MISSING)
+        if result is MISSING:
+            result = self.simplify(text) if direction == "simplified" else self.traditionalize(text)
+            self.memo.put((direction, text), result)
+        return result
+
+    def simplify(self, text):
+        return text.translate(self.simplified_table)
+
+    def traditionalize(self, text):
+        converted = list(text.translate(self.traditional_table))
+        for match in self.ambiguous_pattern.finditer(text):
+            i = match.start()
+            converted[i] = self.choose(text[i], converted[i - 1] if i else None,
+                                       text[i + 1] if i + 1 < len(text) else None)
+        return "".join(converted)
+
+    def chunks(self, text, size=65536):
+        """Splits text on line ends so every chunk converts exactly as it would in the whole text."""
+        start = 0
+        while start < len(text):
+            end = text.find("\n", start + size)
+            end = len(text) if end == -1 else end + 1
+            yield text[start:end]
+            start = end
+
+
+CONVERTER = ChineseConverter()
+METRICS.gauge("conversion_cache_hit_ratio", lambda: hit_ratio(CONVERTER.memo.hits, CONVERTER.memo.misses))
+
+
+HAN = re.compile(r"([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)")
+TONE_MARKS = {'1': '\u0304', '2': '\u0301', '3': '\u030c', '4': '\u0300'}
+
+
+def load_cedict_words():
+    """Multi-character CEDICT words -> numerical pinyin syllables, from the copy bundled with the pinyin package."""
+    words = {}
+    with gzip.open(os.path.join(os.path.dirname(pinyin.__file__), "cedict.txt.gz"), mode='rt',
+                   encoding='utf-8') as file:
+        for line in file:
+            if line.startswith('#'):
+                continue
+            traditional, simplified, rest = line.split(' ', 2)
+            syllables = tuple(rest[1:rest.index(']')].lower().replace('u:', 'v').split())
+            for word in (traditional, simplified):
+                if len(word) > 1 and len(word) == len(syllables) and HAN.fullmatch(word):
+                    words.setdefault(word, syllables)
+    return words
+
+
+def mark_tone(syllable):
+    base, tone = (syllable[:-1], syllable[-1]) if syllable[-1].isdigit() else (syllable, '5')
+    base = base.replace('v', 'ü')
+    if tone not in TONE_MARKS:
+        return base
+    vowels = [i for i, c in enumerate(base) if c in "aeiouü"]
+    if not vowels:
+        return base
+    if 'a' in base or 'e' in base:
+        vowel = base.index('a') if 'a' in base else base.index('e')
+    elif "ou" in base:
+        vowel = base.index('o')
+    else:
+        vowel = vowels[-1]
+    return unicodedata.normalize('NFC', base[:vowel + 1] + TONE_MARKS[tone] + base[vowel + 1:])
+
+
+class PinyinTransliterator:
+    """Longest-match CEDICT word segmentation, cached per run of Han characters and rendered in any pinyin style."""
+
+    def __init__(self, words, max_word=8, cache_size=4096):
+        self.words = words
+        self.max_word = max_word
+        self.segments = LRUCache(cache_size)
+
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def character(char):
+        return pinyin.get(char, format="numerical")
+
+    @staticmethod
+    @lru_cache(maxsize=16384)
+    def render(syllables, style):
+        if style == "numerical":
+            return "".join(syllables)
+        if style == "strip":
+            return "".join(syllable.rstrip("012345") for syllable in syllables)
+        return "".join(mark_tone(syllable) for syllable in syllables)
+
+    def segment(self, run):
+        words = self.segments.get(run)
+        if words is None:
+            words, i = [], 0
+            while i < len(run):
+                for length in range(min(self.max_word, len(run) - i), 1, -1):
+                    syllables = self.words.get().get(run[i:i + length])
+                    if syllables:
+                        break
+                else:
+                    length, syllables = 1, (self.character(run[i]),)
+                words.append(syllables)
+                i += length
+            words = tuple(words)
+            self.segments.put(run, words)
+        return words
+
+    def transliterate(self, text, style="diacritical"):
+        with METRICS.timer("transliteration"):
+            return self.render_text(text, style)
+
+    def render_text(self, text, style):
+        parts = HAN.split(text)
+        for i in range(1, len(parts), 2):
+            rendered = " ".join(self.render(word, style) for word in self.segment(parts[i]))
+            before, after = parts[i - 1], parts[i + 1]
+            parts[i] = (" " if before[-1:].isalnum() else "") + rendered + (" " if after[:1].isalnum() else "")
+        return "".join(parts)
+
+    def transliterate_many(self, texts, style="diacritical"):
+        return [self.transliterate(text, style) for text in texts]
+
+
+TRANSLITERATOR = PinyinTransliterator(Lazy(load_cedict_words))
+METRICS.gauge("segmentation_cache_hit_ratio",
+              lambda: hit_ratio(TRANSLITERATOR.segments.hits, TRANSLITERATOR.segments.misses))
+MAX_FILE_SIZE = 8 * 1024 * 1024
+
+
+SCRIPT_RANGES = {
+    "latin": [(0x41, 0x5A), (0x61, 0x7A), (0xC0, 0xD6), (0xD8, 0xF6), (0xF8, 0x24F), (0x1E00, 0x1EFF)],
+    "greek": [(0x370, 0x3FF), (0x1F00, 0x1FFF)],
+    "cyrillic": [(0x400, 0x52F), (0x1C80, 0x1C8F), (0x2DE0, 0x2DFF), (0xA640, 0xA69F)],
+    "arabic": [(0x600, 0x6FF), (0x750, 0x77F), (0x8A0, 0x8FF), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF)],
+    "han": [(0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF)],
+    "kana": [(0x3040, 0x30FF), (0x31F0, 0x31FF), (0xFF66, 0xFF9F)],
+    "hangul": [(0x1100, 0x11FF), (0x3130, 0x318F), (0xAC00, 0xD7AF)],
+}
+SCRIPT_MARKS = {script: chr(i) for i, script in enumerate(SCRIPT_RANGES, start=1)}
+SCRIPT_LANGUAGES = {"greek": {"el"}, "cyrillic": {"ru"}, "arabic": {"ar"}, "han": {"zh"}, "kana": {"ja"},
+                    "hangul": {"ko"}}
+CJK_WORD = re.compile(r"[\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f]+|[^\W\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f]+")
+
+
+def script_table():
+    table = {ord(mark): None for mark in SCRIPT_MARKS.values()}
+    for script, ranges in SCRIPT_RANGES.items():
+        for start, end in ranges:
+            table.update(dict.fromkeys(range(start, end + 1), SCRIPT_MARKS[script]))
+    return table
 
 
-bot = commands.Bot(command_prefix='!', intents=discord.Intents.all())
+SCRIPT_TABLE = script_table()
+
+
+def script_histogram(text):
+    marked = text.translate(SCRIPT_TABLE)
+    return {script: marked.count(mark) for script, mark in SCRIPT_MARKS.items()}
+
+
+def dominant_script(text, share=0.9):
+    counts = script_histogram(text)
+    total = sum(counts.values())
+    if not total:
+        return None
+    if counts["kana"] and counts["kana"] + counts["han"] >= share * total:
+        return "kana"
+    script = max(counts, key=counts.get)
+    return script if counts[script] >= share * total else None
+
+
+def script_ruling(script, allowed):
+    """True or False when the script alone settles whether the text is allowed, None when the detector must decide."""
+    if script is None:
+        return None
+    allowed = {code.split('-')[0] for code in allowed}
+    if script == "latin":
+        return False if allowed <= set().union(*SCRIPT_LANGUAGES.values()) else None
+    candidates = SCRIPT_LANGUAGES[script]
+    if candidates <= allowed:
+        return True
+    if not candidates & allowed:
+        return False
+    return None
+
+
+def count_words(text, script):
+    if script not in ("han", "kana"):
+        return len(text.split())
+    parts = HAN.split(text)
+    return sum(len(TRANSLITERATOR.segment(part)) if i % 2 else len(CJK_WORD.findall(part))
+               for i, part in enumerate(parts))
+
+
+WORD_START = r"(?<![^\W\d_])(?<!['’ʼ])"
+
+
+class Romanizer:
+    """One romanization scheme: a str.translate table for single letters, and one regex pass before it for letter
+    sequences and letters whose romanization depends on their neighbours.
+
+    Rules are (first letters, pattern, replacement); the first letters let the regex skip every other position.
+    Capitals romanized as several letters also go through the regex, to be upper-cased next to other capitals."""
+
+    def __init__(self, letters, rules=()):
+        capitals = {letter.upper(): latin for letter, latin in letters.items()
+                    if letter.upper() != letter and len(letter.upper()) == 1}
+        self.table = str.maketrans({**letters, **{capital: latin[:1].upper() + latin[1:]
+                                                  for capital, latin in capitals.items()}})
+        digraphs = "".join(capital for capital, latin in capitals.items() if len(latin) > 1)
+        if digraphs:
+            rules = [*rules, (digraphs, f"(?-i:[{re.escape(digraphs)}])", lambda text: capitals[text])]
+        self.replacements = [replacement for _, _, replacement in rules]
+        first = re.escape("".join(sorted({letter for letters, _, _ in rules for letter in letters})))
+        self.pattern = re.compile(f"(?=[{first}])(?:" + "|".join(f"(?P<r{i}>{pattern})"
+                                                                  for i, (_, pattern, _) in enumerate(rules)) + ")",
+                                  re.IGNORECASE) if rules else None
+
+    def replace(self, match):
+        text = match.group()
+        replacement = self.replacements[int(match.lastgroup[1:])]
+        latin = replacement(text) if callable(replacement) else replacement
+        if not text[0].isupper() or not latin:
+            return latin
+        before = match.string[match.start() - 1:match.start()]
+        after = match.string[match.end():match.end() + 1]
+        if (len(text) > 1 and text.isupper()) or before.isupper() or after.isupper():
+            return latin.upper()
+        return latin[0].upper() + latin[1:]
+
+    def __call__(self, text):
+        if self.pattern:
+            text = self.pattern.sub(self.replace, text)
+        return text.translate(self.table)
+
+
+def sequences(mapping):
+    """Rules replacing each key wherever it occurs, longest first."""
+    return [(key[0], re.escape(key), value) for key, value in sorted(mapping.items(), key=lambda item: -len(item[0]))]
+
+
+def initial(mapping, after=""):
+    """Rules for letters romanized differently at the start of a word or after one of the letters in `after`."""
+    context = f"(?:{WORD_START}|(?<=[{after}]))" if after else WORD_START
+    return [(key[0], context + re.escape(key), value) for key, value in mapping.items()]
+
+
+CYRILLIC_ISO9 = dict(zip("абвгґдѓђеёєжзѕиіїйјклљмнњопрстќћуўфхцчџшщъыьэюя",
+                         ["a", "b", "v", "g", "g̀", "d", "ǵ", "đ", "e", "ë", "ê", "ž", "z", "ẑ", "i", "ì", "ï", "j", "ǰ",
+                          "k", "l", "l̂", "m", "n", "n̂", "o", "p", "r", "s", "t", "ḱ", "ć", "u", "ŭ", "f", "h", "c",
+                          "č", "d̂", "š", "ŝ", "ʺ", "y", "ʹ", "è", "û", "â"]))
+RUSSIAN_SCIENTIFIC = dict(zip("абвгдеёжзийклмнопрстуфхцчшщъыьэюя",
+                              ["a", "b", "v", "g", "d", "e", "ë", "ž", "z", "i", "j", "k", "l", "m", "n", "o", "p", "r",
+                               "s", "t", "u", "f", "x", "c", "č", "š", "šč", "ʺ", "y", "ʹ", "è", "ju", "ja"]))
+UKRAINIAN_SCIENTIFIC = {**RUSSIAN_SCIENTIFIC, "г": "h", "ґ": "g", "є": "je", "и": "y", "і": "i", "ї": "ji",
+                        "'": "'", "’": "’"}
+RUSSIAN_BGN = dict(zip("абвгдеёжзийклмнопрстуфхцчшщъыьэюя",
+                       ["a", "b", "v", "g", "d", "e", "ë", "zh", "z", "i", "y", "k", "l", "m", "n", "o", "p", "r", "s",
+                        "t", "u", "f", "kh", "ts", "ch", "sh", "shch", "ʺ", "y", "ʹ", "e", "yu", "ya"]))
+UKRAINIAN_BGN = {**RUSSIAN_BGN, "г": "h", "ґ": "g", "є": "ie", "и": "y", "і": "i", "ї": "i", "й": "i", "ь": "",
+                 "ю": "iu", "я": "ia", "'": "", "’": "", "ʼ": ""}
+SERBIAN_LATIN = dict(zip("абвгдђежзијклљмнњопрстћуфхцчџш",
+                         ["a", "b", "v", "g", "d", "đ", "e", "ž", "z", "i", "j", "k", "l", "lj", "m", "n", "nj", "o",
+                          "p", "r", "s", "t", "ć", "u", "f", "h", "c", "č", "dž", "š"]))
+GREEK_ELOT = dict(zip("αάβγδεέζηήθιίϊΐκλμνξοόπρσςτυύϋΰφχψωώ",
+                      ["a", "á", "v", "g", "d", "e", "é", "z", "i", "í", "th", "i", "í", "ï", "ḯ", "k", "l", "m", "n",
+                       "x", "o", "ó", "p", "r", "s", "s", "t", "y", "ý", "ÿ", "ÿ́", "f", "ch", "ps", "o", "ó"]))
+GREEK_VOICELESS = "θκξπσςτφχψ"
+ARABIC_SUN = "تثدذرزسشصضطظلن"
+ARABIC_DIN = {**dict(zip("ءأإؤئآابتثجحخدذرزسشصضطظعغفقكلمنهويىة",
+                         ["ʾ", "ʾ", "ʾ", "ʾ", "ʾ", "ʾā", "ā", "b", "t", "ṯ", "ǧ", "ḥ", "ḫ", "d", "ḏ", "r", "z", "s", "š",
+                          "ṣ", "ḍ", "ṭ", "ẓ", "ʿ", "ġ", "f", "q", "k", "l", "m", "n", "h", "w", "y", "ā", "a"])),
+              "\u064b": "an", "\u064c": "un", "\u064d": "in", "\u064e": "a", "\u064f": "u", "\u0650": "i",
+              "\u0652": "", "\u0651": "", "\u0640": "", "،": ",", "؛": ";", "؟": "?",
+              **{chr(0x660 + digit): str(digit) for digit in range(10)}}
+
+
+def doubled(letters):
+    """A letter written with shadda, which may come before or after its vowel sign."""
+    return lambda text: letters[text[0]] * 2 + "".join(letters[sign] for sign in text[1:-1])
+
+
+def sun_article(letters):
+    """al- assimilated to a following sun letter, which carries the shadda: الشَّمْس is aš-šams."""
+    return lambda text: f"a{letters[text[2]]}-{letters[text[2]]}" + "".join(letters[sign] for sign in text[3:])
+
+
+def greek_upsilon(consonant):
+    """αυ, ευ and ηυ: the vowel keeps the accent written on the υ."""
+    return lambda text: ("áéí" if text[1] in "ύΎ" else "aei")["αεη".index(text[0].lower())] + consonant
+
+
+CYRILLIC_ISO9_ROMANIZER = Romanizer(CYRILLIC_ISO9)
+SERBIAN_ROMANIZER = Romanizer(SERBIAN_LATIN)
+
+
+ROMANIZERS = {
+    "ru": {"iso9": CYRILLIC_ISO9_ROMANIZER,
+           "scientific": Romanizer(RUSSIAN_SCIENTIFIC),
+           "bgn": Romanizer(RUSSIAN_BGN, initial({"е": "ye", "ё": "yë"}, after="аеёиоуыэюяйъь"))},
+    "uk": {"iso9": CYRILLIC_ISO9_ROMANIZER,
+           "scientific": Romanizer(UKRAINIAN_SCIENTIFIC),
+           "bgn": Romanizer(UKRAINIAN_BGN, sequences({"зг": "zgh"}) +
+                            initial({"є": "ye", "ї": "yi", "й": "y", "ю": "yu", "я": "ya"}))},
+    "sr": {"iso9": CYRILLIC_ISO9_ROMANIZER, "scientific": SERBIAN_ROMANIZER, "bgn": SERBIAN_ROMANIZER},
+    "el": {"elot": Romanizer(GREEK_ELOT, initial({"μπ": "b", "ντ": "d"}) + [
+        ("αεη", f"[αεη][υύ](?=[{GREEK_VOICELESS}]|\\W|$)", greek_upsilon("f")),
+        ("αεη", "[αεη][υύ]", greek_upsilon("v"))] +
+        sequences({"ου": "ou", "ού": "oú", "γγ": "ng", "γξ": "nx", "γχ": "nch"}))},
+    "ar": {"din": Romanizer(ARABIC_DIN, [
+        ("\u0627", rf"(?<![\w\u064b-\u0652])\u0627\u0644[{ARABIC_SUN}][\u064b-\u0650]?\u0651?",
+         sun_article(ARABIC_DIN)),
+        ("\u0627", r"(?<![\w\u064b-\u0652])\u0627\u0644", "al-"),
+        ("".join(map(chr, range(0x621, 0x64b))), r"[\u0621-\u064a][\u064b-\u0650]?\u0651", doubled(ARABIC_DIN))] +
+        sequences({"\u064e\u0627": "ā", "\u064f\u0648": "ū", "\u0650\u064a": "ī"}))},
+}
+
+
+def cyrillic_language(text):
+    letters = set(text.lower())
+    if letters & set("ґєії"):
+        return "uk"
+    if letters & set("ђјљњћџ"):
+        return "sr"
+    return "ru"
+
+
+def romanize(text, language, scheme=None):
+    with METRICS.timer("romanization"):
+        schemes = ROMANIZERS[language]
+        return schemes[scheme or next(iter(schemes))](text)
+
+
+class LanguageWindow:
+    """One user's text in one channel since the last ruling; forgotten after `idle` seconds without a message."""
+
+    def __init__(self):
+        self.texts = []
+        self.words = 0
+        self.seen = 0.0
+
+    def add(self, text, words, now, idle):
+        if self.seen < now - idle:
+            self.texts.clear()
+            self.words = 0
+        self.texts.append(text)
+        self.words += words
+        self.seen = now
+
+    def take(self):
+        """The text since the last ruling; text already ruled on must not dilute it."""
+        text = "\n".join(self.texts)
+        self.texts.clear()
+        self.words = 0
+        return text
+
+
+class LanguageWindows:
+    """Text since the last ruling per (user, channel), judged together once it has enough words."""
+
+    def __init__(self, max_windows=5000, idle=300):
+        self.windows = OrderedDict()
+        self.max_windows = max_windows
+        self.idle = idle
+
+    def __len__(self):
+        return len(self.windows)
+
+    def add(self, key, text, words):
+        now = time.monotonic()
+        window = self.windows.pop(key, None) or LanguageWindow()
+        window.add(text, words, now, self.idle)
+        self.windows[key] = window
+        while self.windows:
+            oldest = next(iter(self.windows.values()))
+            if len(self.windows) <= self.max_windows and oldest.seen >= now - self.idle:
+                break
+            self.windows.popitem(last=False)
+        return window
+
+
+WINDOWS = LanguageWindows()
+METRICS.gauge("language_windows", lambda: len(WINDOWS))
+
+
+@dataclass
+class Ruling:
+    """What an immersion-channel message was last judged on, and the warning reply it got, if any."""
+
+    digest: bytes
+    sketch: bytes
+    warning: int = None
+
+
+def text_digest(text):
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=8).digest()
+
+
+SKETCH_SIZE = 64
+
+
+def text_sketch(text, size=SKETCH_SIZE):
+    """The size smallest hashes of text's character 4-grams, packed: a bottom-k MinHash sketch of the text."""
+    hashes = sorted({hash(text[i:i + 4]) for i in range(max(1, len(text) - 3))})[:size]
+    return struct.pack(f"{len(hashes)}q", *hashes)
+
+
+def text_changed(old, new, similarity=0.67):
+    """Whether the 4-gram Jaccard similarity estimated from two text_sketch()es is below similarity."""
+    old, new = {h for h, in struct.iter_unpack("q", old)}, {h for h, in struct.iter_unpack("q", new)}
+    union = sorted(old | new)[:SKETCH_SIZE]
+    return sum(h in old and h in new for h in union) < similarity * len(union)
+
+
+RULINGS = LRUCache(20000)
+METRICS.gauge("message_rulings", lambda: len(RULINGS))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, now):
+        """Seconds until a token is available, 0 if one is available now."""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now, count=1):
+        self.refill(now)
+        self.tokens = max(self.tokens - count, -self.capacity)
+
+
+PRIORITY_GREETING, PRIORITY_WARNING = range(2)
+
+
+@dataclass
+class Outgoing:
+    channel: object
+    kwargs: dict
+    key: object = None
+    sent: object = None
+
+
+class Outbox:
+    """Schedules the bot's own channel messages under per-channel token buckets and a shared global budget.
+
+    Interactions are answered directly but draw from the global bucket first (see on_interaction), so queued
+    notices yield to them. Warnings with the same key are merged while queued and suppressed for `coalesce`
+    seconds after one was sent."""
+
+    def __init__(self, channel_rate=(5, 5.0), global_rate=(40, 1.0), coalesce=30, max_queued=1000):
+        self.channel_rate = channel_rate
+        self.buckets = OrderedDict()
+        self.budget = TokenBucket(global_rate[0] / global_rate[1], global_rate[0])
+        self.coalesce = coalesce
+        self.max_queued = max_queued
+        self.queue = []
+        self.sequence = 0
+        self.pending = {}
+        self.recent = OrderedDict()
+        self.wakeup = None
+        self.worker = None
+
+    def __len__(self):
+        return len(self.queue)
+
+    def bucket(self, channel_id):
+        bucket = self.buckets.pop(channel_id, None) or TokenBucket(self.channel_rate[0] / self.channel_rate[1],
+                                                                   self.channel_rate[0])
+        self.buckets[channel_id] = bucket
+        if len(self.buckets) > 10000:
+            self.buckets.popitem(last=False)
+        return bucket
+
+    def reserve(self, count=1):
+        self.budget.take(time.monotonic(), count)
+
+    def send(self, channel, priority=PRIORITY_GREETING, key=None, sent=None, **kwargs):
+        """Queues a message; returns False when it was merged into a pending one or suppressed. `sent` is called
+        with the posted message."""
+        now = time.monotonic()
+        while self.recent and next(iter(self.recent.values())) < now - self.coalesce:
+            self.recent.popitem(last=False)
+        if key is not None and key in self.pending:
+            METRICS.count("outbox_coalesced", state="queued")
+            return False
+        if key is not None and key in self.recent:
+            METRICS.count("outbox_coalesced", state="sent")
+            return False
+        if len(self.queue) >= self.max_queued:
+            METRICS.count("outbox_dropped")
+            log.warning("outbox full, message dropped", extra={"fields": {"channel": channel.id}})
+            return False
+        item = Outgoing(channel, kwargs, key, sent=sent)
+        if key is not None:
+            self.pending[key] = item
+        self.sequence += 1
+        heapq.heappush(self.queue, (priority, self.sequence, item))
+        self.start()
+        self.wakeup.set()
+        return True
+
+    def cancel(self, key):
+        """Drops the queued message with this key, if it has not been sent yet; returns whether one was dropped."""
+        item = self.pending.pop(key, None)
+        if item is None:
+            return False
+        self.queue = [entry for entry in self.queue if entry[2] is not item]
+        heapq.heapify(self.queue)
+        METRICS.count("outbox_cancelled")
+        return True
+
+    def start(self):
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    def next_ready(self):
+        """Pops the most urgent message whose channel has a token, or returns the seconds to wait for one."""
+        now = time.monotonic()
+        delay = self.budget.wait(now)
+        if delay:
+            return None, delay
+        for entry in sorted(self.queue):
+            channel_delay = self.bucket(entry[2].channel.id).wait(now)
+            if not channel_delay:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                return entry[2], 0.0
+            delay = min(delay or channel_delay, channel_delay)
+        return None, delay
+
+    async def run(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            item, delay = self.next_ready()
+            if item is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.monotonic()
+            self.budget.take(now)
+            self.bucket(item.channel.id).take(now)
+            if item.key is not None:
+                del self.pending[item.key]
+                self.recent[item.key] = now
+            try:
+                with METRICS.timer("outbox_send"):
+                    message = await item.channel.send(**item.kwargs)
+                METRICS.count("outbox_sent")
+                if item.sent:
+                    item.sent(message)
+            except discord.HTTPException as error:
+                METRICS.count("outbox_errors")
+                log.warning("outbox send failed", extra={"fields": {"channel": item.channel.id, "error": str(error)}})
+
+
+OUTBOX = Outbox()
+METRICS.gauge("outbox_queued", lambda: len(OUTBOX))
+
+
+class WelcomeChannels:
+    """Welcome channel ID per guild, resolved by name once and invalidated by channel events."""
+
+    def __init__(self, name="welcome"):
+        self.name = name
+        self.ids = {}
+
+    def get(self, guild):
+        if guild.id not in self.ids:
+            channel = discord.utils.get(guild.channels, name=self.name)
+            self.ids[guild.id] = channel.id if channel else None
+            METRICS.count("welcome_channel_lookups")
+        return guild.get_channel(self.ids[guild.id]) if self.ids[guild.id] else None
+
+    def changed(self, *channels):
+        for channel in channels:
+            if channel.name == self.name or self.ids.get(channel.guild.id) == channel.id:
+                self.ids.pop(channel.guild.id, None)
+
+    def forget(self, guild):
+        self.ids.pop(guild.id, None)
+
+
+class Greeter:
+    """Greets joins one by one, or in a single message per `delay` seconds once more than `burst` members
+    join a guild within `period` seconds."""
+
+    def __init__(self, burst=5, period=10, delay=5, max_mentions=40):
+        self.burst = burst
+        self.period = period
+        self.delay = delay
+        self.max_mentions = max_mentions
+        self.joins = defaultdict(deque)
+        self.pending = {}
+
+    def join(self, channel, member_id):
+        now = time.monotonic()
+        joins = self.joins[channel.guild.id]
+        joins.append(now)
+        while joins[0] < now - self.period:
+            joins.popleft()
+        if channel.guild.id in self.pending:
+            self.pending[channel.guild.id].append(member_id)
+        elif len(joins) > self.burst:
+            self.pending[channel.guild.id] = [member_id]
+            asyncio.get_running_loop().call_later(self.delay, self.flush, channel)
+        else:
+            self.greet(channel, [member_id])
+
+    def flush(self, channel):
+        members = self.pending.pop(channel.guild.id, [])
+        METRICS.count("welcome_batches")
+        for i in range(0, len(members), self.max_mentions):
+            self.greet(channel, members[i:i + self.max_mentions])
+
+    def greet(self, channel, members):
+        mentions = " ".join(f"<@{member_id}>" for member_id in members)
+        METRICS.count("welcome_greetings", len(members))
+        OUTBOX.send(channel, PRIORITY_GREETING, content=f"{mentions} {random.choice(WELCOME_MSGS)}")
+
+
+WELCOME_CHANNELS = WelcomeChannels()
+GREETER = Greeter()
+
+
+class WiktionaryCache:
+    """SQLite cache of parsed WiktionaryParser results keyed by (word, language)."""
+
+    def __init__(self, path, ttl=30 * 86400, negative_ttl=86400, max_entries=50000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (word TEXT, language TEXT, result TEXT, fetched REAL, "
+                        "used REAL, PRIMARY KEY (word, language))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS languages (language TEXT PRIMARY KEY, lookups INTEGER)")
+        self.db.commit()
+
+    def get(self, word, language):
+        language = language.lower()
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT result, fetched FROM entries WHERE word = ? AND language = ?",
+                                  (word, language)).fetchone()
+            if row is None:
+                return MISSING
+            result = json.loads(row[0])
+            if now - row[1] > (self.ttl if result else self.negative_ttl):
+                self.db.execute("DELETE FROM entries WHERE word = ? AND language = ?", (word, language))
+                self.db.commit()
+                return MISSING
+            self.db.execute("UPDATE entries SET used = ? WHERE word = ? AND language = ?", (now, word, language))
+            self.db.commit()
+        return result
+
+    def put(self, word, language, result):
+        self.put_many([(word, language, result)])
+
+    def put_many(self, entries):
+        now = time.time()
+        rows = [(word, language.lower(), json.dumps(result), now, now) for word, language, result in entries]
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.execute("DELETE FROM entries WHERE rowid IN "
+                            "(SELECT rowid FROM entries ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self.db.commit()
+        return len(rows)
+
+    def count_lookups(self, counts):
+        with self.lock:
+            self.db.executemany("INSERT INTO languages VALUES (?, ?) "
+                                "ON CONFLICT (language) DO UPDATE SET lookups = lookups + excluded.lookups",
+                                [(language.lower(), count) for language, count in counts.items()])
+            self.db.commit()
+
+    def lookups(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT language, lookups FROM languages"))
+
+
+WIKTIONARY_CACHE = WiktionaryCache(os.path.join(CACHE_DIR, "wiktionary.sqlite3"))
+
+
+class WiktionaryIndex:
+    """Read-only, memory-mapped (language, word) -> parser result table built from parser-shaped dumps.
+
+    Layout: header, fixed-size records sorted by key, key bytes, zlib-compressed JSON entries.
+    """
+
+    MAGIC = b"LBWIKT01"
+    HEADER = struct.Struct("<8sII")
+    RECORD = struct.Struct("<IIQI")
+
+    def __init__(self, path):
+        with open(path, mode='rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, keys_size = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{path} is not a Wiktionary index")
+        self.records = self.HEADER.size
+        self.keys = self.records + self.count * self.RECORD.size
+        self.entries = self.keys + keys_size
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def key(word, language):
+        return f"{language.lower()}\0{word}".encode('utf-8')
+
+    def record(self, i):
+        key_offset, key_length, entry_offset, entry_length = self.RECORD.unpack_from(
+            self.map, self.records + i * self.RECORD.size)
+        key = self.map[self.keys + key_offset:self.keys + key_offset + key_length]
+        return key, self.entries + entry_offset, entry_length
+
+    def get(self, word, language):
+        key = self.key(word, language)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            found, offset, length = self.record(middle)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return json.loads(zlib.decompress(self.map[offset:offset + length]))
+        return MISSING
+
+    @classmethod
+    def open(cls, path):
+        try:
+            return cls(path)
+        except (OSError, ValueError) as error:
+            if os.path.exists(path):
+                log.error("index unavailable", extra={"fields": {"path": path, "error": repr(error)}})
+            return None
+
+    @classmethod
+    def build(cls, entries, path):
+        """Writes (word, language, result) entries to path, replacing any previous index atomically."""
+        table = sorted((cls.key(word, language), zlib.compress(json.dumps(result).encode('utf-8')))
+                       for word, language, result in entries)
+        table = list({key: entry for key, entry in table}.items())
+        records, keys, blobs = [], bytearray(), bytearray()
+        for key, entry in table:
+            records.append(cls.RECORD.pack(len(keys), len(key), len(blobs), len(entry)))
+            keys += key
+            blobs += entry
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + ".tmp", mode='wb') as file:
+            file.write(cls.HEADER.pack(cls.MAGIC, len(table), len(keys)))
+            file.writelines(records)
+            file.write(keys)
+            file.write(blobs)
+        os.replace(path + ".tmp", path)
+        return len(table)
+
+
+WIKTIONARY_INDEX_PATH = os.environ.get("WIKTIONARY_INDEX", os.path.join(CACHE_DIR, "wiktionary.idx"))
+WIKTIONARY_INDEX = WiktionaryIndex.open(WIKTIONARY_INDEX_PATH)
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def pooled_session(timeout):
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(timeout, max_retries=2, pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+LOOKUP_TIMEOUT = 8
+HTTP = pooled_session(timeout=6)
+NETWORK = ThreadPoolExecutor(max_workers=8, thread_name_prefix="network")
+METRICS.gauge("network_queue_depth", lambda: NETWORK._work_queue.qsize())
+# Image searches get their own thread, so a slow Custom Search API never holds up dictionary lookups.
+IMAGES = ThreadPoolExecutor(max_workers=1, thread_name_prefix="images")
+METRICS.gauge("image_queue_depth", lambda: IMAGES._work_queue.qsize())
+
+
+def wiktionary_parser():
+    from wiktionaryparser import WiktionaryParser
+    parser = WiktionaryParser()
+    parser.session = HTTP
+    return parser
+
+
+class LanguageIndex:
+    """Prefix index over Wiktionary language names, matching at every word start. Exact matches rank first, then
+    names starting with the prefix, then matches inside a name, each by lookup count; `seeds` start at one lookup."""
+
+    def __init__(self, names, lookups, seeds=()):
+        self.names = {name.casefold(): name for name in names}
+        self.keys = sorted((key[i:], name) for key, name in self.names.items()
+                           for i in range(len(key)) if i == 0 or key[i - 1] in " -")
+        self.lookups = defaultdict(int, {key.casefold(): count for key, count in lookups.items()})
+        for name in seeds:
+            if name.casefold() in self.names:
+                self.lookups[name.casefold()] = max(self.lookups[name.casefold()], 1)
+        self.unsaved = defaultdict(int)
+
+    def canonical(self, language):
+        return self.names.get(language.strip().casefold())
+
+    def suggest(self, language, limit=3):
+        return [self.names[key] for key in difflib.get_close_matches(language.strip().casefold(), self.names, limit)]
+
+    def record(self, name):
+        self.lookups[name.casefold()] += 1
+        self.unsaved[name.casefold()] += 1
+
+    def unsaved_lookups(self):
+        unsaved, self.unsaved = self.unsaved, defaultdict(int)
+        return unsaved
+
+    def complete(self, prefix, limit=25):
+        prefix = prefix.strip().casefold()
+        start = bisect.bisect_left(self.keys, (prefix,))
+        end = bisect.bisect_left(self.keys, (prefix + "\U0010ffff",))
+        ranks = {}
+        for key, name in self.keys[start:end]:
+            rank = 0 if key == prefix and key == name.casefold() else 1 if key == name.casefold() else 2
+            ranks[name] = min(rank, ranks.get(name, 2))
+        return heapq.nsmallest(limit, ranks, key=lambda name: (ranks[name], -self.lookups[name.casefold()], name))
+
+
+WIKTIONARY_LANGUAGES_PATH = 'JSON/wiktionary_languages.json'
+WIKTIONARY_LANGUAGES_SOURCE = "https://en.wiktionary.org/wiki/Wiktionary:List_of_languages,_csv_format"
+
+
+def wiktionary_language_names(text):
+    """Canonical names from Wiktionary's language list: the ';'-separated csv format page with its header row, or a
+    tab-separated code/name table such as the snapshot shipped with language_data."""
+    match = re.search(r"<pre>(.*?)</pre>", text, re.S)
+    lines = [line for line in html.unescape(match.group(1) if match else text).splitlines() if line.strip()]
+    header = lines[0].split(";")
+    if "canonical name" in header:
+        column = header.index("canonical name")
+        return {line.split(";")[column].strip() for line in lines[1:]} - {""}
+    return {line.split("\t")[1].strip() for line in lines if "\t" in line} - {""}
+
+
+def update_wiktionary_languages(source=WIKTIONARY_LANGUAGES_SOURCE, path=WIKTIONARY_LANGUAGES_PATH):
+    """Regenerates the /wiktionary language list from Wiktionary's list of languages, a URL or a saved copy."""
+    if os.path.exists(source):
+        with open(source, mode='r', encoding='utf-8') as file:
+            text = file.read()
+    else:
+        response = HTTP.get(source, timeout=LOOKUP_TIMEOUT)
+        response.raise_for_status()
+        text = response.text
+    names = sorted(wiktionary_language_names(text) | {"Translingual"}, key=str.casefold)
+    with open(path, mode='w', encoding='utf-8') as file:
+        json.dump(names, file, ensure_ascii=False, indent=2)
+        file.write("\n")
+    return len(names)
+
+
+def served_languages():
+    """English names of the languages with a word of the day or an immersion channel, where lingua knows the code."""
+    codes = {code.lower() for code in WOD}
+    codes.update(code.split('-')[0] for policy in IMMERSION.policies.values() for code in policy.allowed)
+    names = set()
+    for code in codes:
+        try:
+            names.add(Language.from_iso_code_639_1(IsoCode639_1.from_str(code)).name.title())
+        except ValueError:
+            pass
+    return names
+
+
+with open(WIKTIONARY_LANGUAGES_PATH, mode='r', encoding='utf-8') as file:
+    WIKTIONARY_LANGUAGES = LanguageIndex(json.load(file), WIKTIONARY_CACHE.lookups(), served_languages())
+
+
+def fetch_wiktionary(search, language):
+    with METRICS.timer("wiktionary"):
+        result = WIKTIONARY_INDEX.get(search, language) if WIKTIONARY_INDEX else MISSING
+        source = "index"
+        if result is MISSING:
+            result = WIKTIONARY_CACHE.get(search, language)
+            source = "cache"
+        if result is MISSING:
+            result = wiktionary_parser().fetch(search, language)
+            WIKTIONARY_CACHE.put(search, language, result)
+            source = "live"
+    METRICS.count("wiktionary_lookups", source=source)
+    return result
+
+
+class ThumbnailCache:
+    """SQLite cache of image search query -> URL, including misses, plus a per-day count of API calls."""
+
+    def __init__(self, path, ttl=30 * 86400, negative_ttl=2 * 86400, daily_quota=90):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.daily_quota = daily_quota
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS thumbnails (query TEXT PRIMARY KEY, url TEXT, fetched REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS quota (day TEXT PRIMARY KEY, used INTEGER)")
+        self.db.commit()
+
+    def get(self, query):
+        """Returns (url, expired) or MISSING."""
+        with self.lock:
+            row = self.db.execute("SELECT url, fetched FROM thumbnails WHERE query = ?", (query,)).fetchone()
+        if row is None:
+            return MISSING
+        url, fetched = row
+        return url, time.time() - fetched > (self.ttl if url else self.negative_ttl)
+
+    def put(self, query, url):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?)", (query, url, time.time()))
+            self.db.commit()
+
+    def reserve(self):
+        """Counts one API call against today's quota, or returns False if it is used up."""
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        with self.lock:
+            row = self.db.execute("SELECT used FROM quota WHERE day = ?", (today,)).fetchone()
+            used = row[0] if row else 0
+            if used >= self.daily_quota:
+                return False
+            self.db.execute("INSERT OR REPLACE INTO quota VALUES (?, ?)", (today, used + 1))
+            self.db.execute("DELETE FROM quota WHERE day < ?", (today,))
+            self.db.commit()
+        return True
+
+
+class ImageSearch:
+    """One Custom Search client for the bot's lifetime; the underlying httplib2 connection is not thread-safe."""
+
+    def __init__(self, developer_key, cx):
+        self.developer_key = developer_key
+        self.cx = cx
+        self.service = None
+        self.lock = threading.Lock()
+
+    def first(self, query):
+        with self.lock:
+            if self.service is None:
+                import httplib2
+                from googleapiclient import discovery
+                self.service = discovery.build("customsearch", "v1", developerKey=self.developer_key,
+                                               http=httplib2.Http(timeout=LOOKUP_TIMEOUT), cache_discovery=False)
+            response = self.service.cse().list(
+                cx=self.cx,
+                q=query,
+                searchType='image',
+                num=1,
+                fileType='jpg|gif|png',
+                imgSize='LARGE',
+                rights='cc_publicdomain|cc_attribute|cc_sharealike|cc_noncommercial|cc_nonderived',
+                safe='off',
+            ).execute()
+        for item in response.get('items', []):
+            try:
+                head = HTTP.head(item['link'], allow_redirects=False)
+            except requests.RequestException:
+                continue
+            if head.status_code == 200 and 'image' in head.headers.get('Content-Type', ''):
+                return item['link']
+        return None
+
+
+THUMBNAILS = ThumbnailCache(os.path.join(CACHE_DIR, "thumbnails.sqlite3"),
+                            daily_quota=int(os.environ.get("GCS_DAILY_QUOTA", 90)))
+IMAGE_SEARCH = ImageSearch(GCS_DEVELOPER_KEY, GCS_CX)
+
+
+def search_image(search):
+    from googleapiclient.errors import HttpError
+    query = normalize_text(search)
+    cached = THUMBNAILS.get(query)
+    if cached is not MISSING and not cached[1]:
+        METRICS.count("image_searches", source="cache")
+        return cached[0]
+    if not THUMBNAILS.reserve():
+        METRICS.count("image_searches", source="quota")
+        return None if cached is MISSING else cached[0]
+    METRICS.count("image_searches", source="api")
+    with METRICS.timer("image_search"):
+        try:
+            url = IMAGE_SEARCH.first(query)
+        except HttpError as error:
+            log.warning("image search failed", extra={"fields": {"query": query, "error": repr(error)}})
+            url = None
+    THUMBNAILS.put(query, url)
+    return url
+
+
+EMBED_LIMIT = 6000
+
+
+def clip(text, limit=1024):
+    return (text[:limit - 4] + "...") if len(text) >= limit else text
+
+
+class WiktionaryPages:
+    """A parsed Wiktionary result browsed one definition group per page; pages are rendered when shown."""
+
+    def __init__(self, search, language, result, thumbnail):
+        self.search = search
+        self.language = language
+        self.result = result
+        self.thumbnail = thumbnail
+        self.pages = [(i, j) for i, entry in enumerate(result) for j in range(len(entry["definitions"]))]
+
+    def __len__(self):
+        return len(self.pages)
+
+    def render(self, page):
+        i, j = self.pages[page]
+        entry = self.result[i]
+        definition = entry["definitions"][j]
+        ipa = "- " + "\n- ".join([n.replace("IPA: ", "") for n in entry["pronunciations"]["text"] if "IPA" in n])
+        pos = definition['partOfSpeech']
+        defs = "- " + "\n- ".join(definition["text"][1:])
+        fields = []
+        if len(ipa) > 2:
+            fields.append(("Pronunciation", ipa, True))
+        if len(pos) > 0:
+            fields.append(("Part of Speech", f"*{pos}*", True))
+        if entry["etymology"]:
+            fields.append(("Etymology", f">>> {entry['etymology']}", False))
+        if definition["examples"]:
+            fields.append(("Examples", "- " + "\n- ".join(definition["examples"]), False))
+        for related in definition.get("relatedWords", []):
+            fields.append((related["relationshipType"].capitalize(), "- " + "\n- ".join(related["words"]), False))
+
+        title = clip(self.search, 256)
+        pages = f" | {page + 1}/{len(self)}" if len(self) > 1 else ""
+        footer = f"Wiktionary | {self.language}{pages}"
+        # Discord rejects embeds over 6000 characters in total, so fields share what the definitions leave.
+        budget = EMBED_LIMIT - len(title) - len(footer)
+        wanted = sum(len(name) + min(len(value), 1024) for name, value, _ in fields)
+        defs = clip(defs, min(4096, max(budget - wanted, 2048)))
+        budget -= len(defs)
+
+        url = f"https://en.wiktionary.org/wiki/{self.search.lower()}#{self.language.replace(' ', '_')}"
+        embed = discord.Embed(title=title, url=url, description=defs, color=discord.Color.blurple())
+        for name, value, inline in fields:
+            room = min(1024, budget - len(name))
+            if room < 16:
+                break
+            value = clip(value, room)
+            embed.add_field(name=name, value=value, inline=inline)
+            budget -= len(name) + len(value)
+        embed.set_footer(text=footer)
+        if self.thumbnail:
+            embed.set_thumbnail(url=self.thumbnail)
+        return embed
+
+
+WIKTIONARY_SESSIONS = LRUCache(512)
+METRICS.gauge("wiktionary_sessions", lambda: len(WIKTIONARY_SESSIONS))
+
+
+class WiktionaryBrowser(discord.ui.View):
+    """Previous/next buttons over the WiktionaryPages stored for one /wiktionary interaction."""
+
+    def __init__(self, interaction, count, timeout=600):
+        super().__init__(timeout=timeout)
+        self.key = interaction.id
+        self.interaction = interaction
+        self.count = count
+        self.page = 0
+        self.update()
+
+    async def on_timeout(self):
+        # The latest interaction's token outlives the view timeout, so it can still take the buttons off.
+        try:
+            await self.interaction.edit_original_response(view=None)
+        except discord.HTTPException as error:
+            log.warning("could not remove wiktionary buttons", extra={"fields": {"error": repr(error)}})
+
+    def update(self):
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page == self.count - 1
+
+    async def turn(self, interaction, step):
+        self.interaction = interaction
+        pages = WIKTIONARY_SESSIONS.get(self.key)
+        if pages is None:
+            self.stop()
+            await interaction.response.edit_message(view=None)
+            return
+        self.page = max(0, min(self.count - 1, self.page + step))
+        self.update()
+        METRICS.count("wiktionary_page_turns")
+        await interaction.response.edit_message(embed=pages.render(self.page), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction, button):
+        await self.turn(interaction, -1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction, button):
+        await self.turn(interaction, 1)
+
+
+def finished(future, done):
+    if future not in done:
+        return None
+    if future.exception():
+        log.warning("lookup failed", extra={"fields": {"error": repr(future.exception())}})
+        return None
+    return future.result()
+
+
+def read_dump(path):
+    """Yields (word, language, result) from {language: {word: result}} parser output, as in testOutput/testOutput.json."""
+    with open(path, mode='r', encoding='utf-8') as file:
+        data = json.load(file)
+    for language, words in data.items():
+        for word, result in words.items():
+            yield word, language, result
+
+
+def prewarm_wiktionary(path):
+    return WIKTIONARY_CACHE.put_many(read_dump(path))
+
+
+async def send_result(interaction, result, filename):
+    """Replies with result, as an attached text file when it is too long for a message."""
+    if len(result) > 2000:
+        await interaction.response.send_message(file=discord.File(io.BytesIO(result.encode("utf-8")),
+                                                                  filename=filename), ephemeral=True)
+    else:
+        await interaction.response.send_message(result, ephemeral=True)
+
+
+async def read_long_text(interaction, file, text):
+    """Defers the interaction and returns the attachment's text, or text; None once the user has been told why not."""
+    if file and file.size > MAX_FILE_SIZE:
+        await interaction.response.send_message("File is too large.", ephemeral=True)
+        return None
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    if file:
+        try:
+            text = (await file.read()).decode("utf-8-sig")
+        except UnicodeDecodeError:
+            await interaction.followup.send("File must be UTF-8 text.", ephemeral=True)
+            return None
+    if not text:
+        await interaction.followup.send("Attach a file or provide text.", ephemeral=True)
+        return None
+    return text
+
+
+def output_name(file, suffix):
+    return f"{os.path.splitext(file.filename)[0] if file else 'text'}.{suffix}.txt"
+
+
+WOD_TOKEN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]|[^\W\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+WOD_POST = ("message_id", "guild_id", "channel_id", "language", "word", "definition", "example", "ipa", "etymology",
+            "author", "date")
+
+
+def wod_key(text):
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def wod_tokens(text):
+    """Words, and single Han characters since Chinese and Japanese are not space-separated."""
+    return WOD_TOKEN.findall(wod_key(text))
+
+
+class WodArchive:
+    """SQLite archive of /wod posts with an in-memory inverted index over words and definitions per language."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS posts (message_id INTEGER PRIMARY KEY, guild_id INTEGER, "
+                        "channel_id INTEGER, language TEXT, word TEXT, definition TEXT, example TEXT, ipa TEXT, "
+                        "etymology TEXT, author TEXT, date TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS backfills (channel_id INTEGER PRIMARY KEY, last_id INTEGER, "
+                        "done INTEGER)")
+        self.db.commit()
+        self.postings = defaultdict(lambda: defaultdict(set))
+        self.heads = defaultdict(list)
+        for row in self.db.execute("SELECT message_id, language, word, definition FROM posts"):
+            self.index(*row)
+
+    def __len__(self):
+        return sum(len(heads) for heads in self.heads.values())
+
+    def index(self, message_id, language, word, definition):
+        postings = self.postings[language]
+        for token in set(wod_tokens(word) + wod_tokens(definition)):
+            postings[token].add(message_id)
+        bisect.insort(self.heads[language], (wod_key(word), message_id))
+
+    def put(self, post):
+        with self.lock:
+            cursor = self.db.execute(f"INSERT OR IGNORE INTO posts VALUES ({', '.join('?' * len(WOD_POST))})",
+                                     [post.get(field) for field in WOD_POST])
+            self.db.commit()
+            if cursor.rowcount:
+                self.index(post["message_id"], post["language"], post["word"], post["definition"] or "")
+        return bool(cursor.rowcount)
+
+    def matches(self, query, language, prefix):
+        if prefix:
+            key = wod_key(query)
+            heads = self.heads.get(language, [])
+            start = bisect.bisect_left(heads, (key,))
+            end = bisect.bisect_left(heads, (key + "\U0010ffff",))
+            return {message_id for _, message_id in heads[start:end]}
+        postings = self.postings.get(language, {})
+        tokens = set(wod_tokens(query))
+        return set.intersection(*(postings.get(token, set()) for token in tokens)) if tokens else set()
+
+    def search(self, query, language=None, prefix=False, limit=10):
+        """Posts whose word starts with `query`, or whose word and definition contain all of its words, newest first."""
+        with self.lock:
+            ids = set()
+            for code in [language] if language else list(self.heads):
+                ids |= self.matches(query, code, prefix)
+            ids = sorted(ids, reverse=True)[:limit]
+            rows = self.db.execute(f"SELECT {', '.join(WOD_POST)} FROM posts WHERE message_id IN "
+                                   f"({', '.join('?' * len(ids))}) ORDER BY message_id DESC", ids).fetchall()
+        return [dict(zip(WOD_POST, row)) for row in rows]
+
+    def checkpoint(self, channel_id):
+        with self.lock:
+            row = self.db.execute("SELECT last_id, done FROM backfills WHERE channel_id = ?", (channel_id,)).fetchone()
+        return row or (None, 0)
+
+    def save_checkpoint(self, channel_id, last_id, done=False):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO backfills VALUES (?, ?, ?)", (channel_id, last_id, int(done)))
+            self.db.commit()
+
+
+WOD_ARCHIVE = WodArchive(os.path.join(CACHE_DIR, "wod.sqlite3"))
+WOD_LANGUAGES = {data["name"]: code for code, data in WOD.items()}  # names may themselves contain " | "
+METRICS.gauge("wod_archive_posts", lambda: len(WOD_ARCHIVE))
+
+
+def parse_wod(message):
+    """Recovers the archive fields from a /wod embed posted before the archive existed."""
+    if not message.embeds or message.author.id != bot.user.id:
+        return None
+    embed = message.embeds[0]
+    date = (embed.author.name or "").rpartition(" | ")[2]
+    footer = embed.footer.text or ""
+    language = next((code for name, code in WOD_LANGUAGES.items() if footer.endswith(f" | {name}")), None)
+    if not language or not embed.title:
+        return None
+    author = footer[:-len(f" | {WOD[language]['name']}")]
+    match = re.fullmatch(r"(.+?) ([/\[].*)", embed.title)
+    word, ipa = match.groups() if match else (embed.title, None)
+    fields = {field.name: field.value for field in embed.fields}
+    return {"message_id": message.id, "guild_id": message.guild.id, "channel_id": message.channel.id,
+            "language": language, "word": word, "definition": embed.description,
+            "example": fields.get(WOD[language]["examples"]), "ipa": ipa,
+            "etymology": fields.get(WOD[language]["etymology"]), "author": author, "date": date}
+
+
+BACKFILLS = {}
+
+
+def start_backfill(channel):
+    """Starts backfill_wod for channel unless one is already running; on_ready runs again on every reconnect."""
+    if channel.id in BACKFILLS:
+        return
+    task = asyncio.create_task(backfill_wod(channel))
+    BACKFILLS[channel.id] = task
+    task.add_done_callback(lambda _: BACKFILLS.pop(channel.id, None))
+
+
+async def backfill_wod(channel):
+    """Archives the /wod posts already in `channel`, once, resuming from the last checkpoint if interrupted."""
+    last_id, done = WOD_ARCHIVE.checkpoint(channel.id)
+    if done:
+        return
+    archived = scanned = 0
+    try:
+        async for message in channel.history(limit=None, after=last_id and discord.Object(last_id), oldest_first=True):
+            post = parse_wod(message)
+            if post:
+                archived += WOD_ARCHIVE.put(post)
+            last_id = message.id
+            scanned += 1
+            if scanned % 100 == 0:
+                WOD_ARCHIVE.save_checkpoint(channel.id, last_id)
+    except discord.HTTPException as error:
+        WOD_ARCHIVE.save_checkpoint(channel.id, last_id)
+        log.warning("wod backfill interrupted", extra={"fields": {"channel": channel.id, "error": str(error)}})
+        return
+    WOD_ARCHIVE.save_checkpoint(channel.id, last_id, done=True)
+    log.info("wod backfill finished", extra={"fields": {"channel": channel.id, "archived": archived}})
+
+
+class AuditStore:
+    """Per-channel immersion audit checkpoints: the last message audited and the statistics so far."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS audits (channel_id INTEGER PRIMARY KEY, last_id INTEGER, "
+                        "stats TEXT)")
+        self.db.commit()
+
+    def load(self, channel_id):
+        with self.lock:
+            row = self.db.execute("SELECT last_id, stats FROM audits WHERE channel_id = ?", (channel_id,)).fetchone()
+        if row is None:
+            return None, {"messages": 0, "short": 0, "checked": 0, "compliant": 0, "languages": {}, "users": {}}
+        return row[0], json.loads(row[1])
+
+    def save(self, channel_id, last_id, stats):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO audits VALUES (?, ?, ?)", (channel_id, last_id, json.dumps(stats)))
+            self.db.commit()
+
+
+AUDITS = AuditStore(os.path.join(CACHE_DIR, "audits.sqlite3"))
+AUDIT_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audit")
+AUDITING = set()
+
+
+def audit_rulings(texts, allowed):
+    """(language, allowed) per prepared text, settled by script where possible. Runs on the audit thread, one
+    detector call per text and without touching the live detection cache."""
+    detector = DETECTOR.get()
+    rulings = []
+    for text in texts:
+        script = dominant_script(text)
+        ruling = script_ruling(script, allowed)
+        if ruling is not None and script != "latin":
+            language = next(iter(SCRIPT_LANGUAGES[script]))
+        else:
+            detected = detector.detect_language_of(normalize_text(text))
+            language = detected.iso_code_639_1.name.lower() if detected else None
+            ruling = language in allowed if ruling is None else ruling
+        rulings.append((language or "unknown", ruling))
+    return rulings
+
+
+def tally(stats, batch, rulings):
+    rulings = iter(rulings)
+    for author_id, name, text in batch:
+        stats["messages"] += 1
+        if text is None:
+            stats["short"] += 1
+            continue
+        language, allowed = next(rulings)
+        user = stats["users"].setdefault(str(author_id), {"name": name, "checked": 0, "compliant": 0,
+                                                          "languages": {}})
+        user["name"] = name
+        for entry in (stats, user):
+            entry["checked"] += 1
+            entry["compliant"] += allowed
+            entry["languages"][language] = entry["languages"].get(language, 0) + 1
+
+
+async def audit_channel(channel, policy, min_words, deadline, page=100, in_flight=2, save_every=10):
+    """Streams `channel` from the last checkpoint, detecting each page on the audit thread while the next is fetched.
+
+    Returns (statistics, messages audited in this run, whether the end of the history was reached). A Discord error
+    is raised after the pages already fetched have been tallied and checkpointed."""
+    last_id, stats = AUDITS.load(channel.id)
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    batch = []
+    audited = 0
+
+    async def drain(limit):
+        nonlocal last_id, audited
+        while len(pending) > limit:
+            done, future, batch_last_id = pending.popleft()
+            tally(stats, done, await future)
+            last_id = batch_last_id
+            audited += len(done)
+            if audited % (page * save_every) == 0:
+                AUDITS.save(channel.id, last_id, stats)
+
+    def submit(message_id):
+        texts = [text for _, _, text in batch if text is not None]
+        pending.append((batch, loop.run_in_executor(AUDIT_EXECUTOR, audit_rulings, texts, policy.allowed), message_id))
+
+    finished = True
+    try:
+        async for message in channel.history(limit=None, after=last_id and discord.Object(last_id),
+                                             oldest_first=True):
+            if message.author.bot:
+                continue
+            text = policy.prepare(message.content)
+            batch.append((message.author.id, message.author.display_name,
+                          text if count_words(text, dominant_script(text)) > min_words else None))
+            if len(batch) >= page:
+                submit(message.id)
+                batch = []
+                await drain(in_flight)
+                if time.monotonic() > deadline:
+                    finished = False
+                    break
+        if batch:
+            submit(message.id)
+    finally:
+        await drain(0)
+        AUDITS.save(channel.id, last_id, stats)
+        METRICS.count("audited_messages", audited)
+    return stats, audited, finished
+
+
+def audit_report(stats):
+    """Per-user and per-language CSV reports."""
+    users = io.StringIO()
+    writer = csv.writer(users)
+    writer.writerow(["user_id", "name", "checked", "compliant", "compliance", "languages"])
+    for user_id, user in sorted(stats["users"].items(), key=lambda item: -item[1]["checked"]):
+        languages = " ".join(f"{language}:{count}" for language, count in
+                             sorted(user["languages"].items(), key=lambda item: -item[1]))
+        writer.writerow([user_id, user["name"], user["checked"], user["compliant"],
+                         f"{user['compliant'] / user['checked']:.3f}", languages])
+    languages = io.StringIO()
+    writer = csv.writer(languages)
+    writer.writerow(["language", "messages", "share"])
+    for language, count in sorted(stats["languages"].items(), key=lambda item: -item[1]):
+        writer.writerow([language, count, f"{count / stats['checked']:.3f}"])
+    return users.getvalue(), languages.getvalue()
+
+
+def bot_intents():
+    """Only the gateway events the bot handles: guild messages and their content, member joins, and guilds."""
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.members = True
+    intents.guild_messages = True
+    intents.message_content = True
+    return intents
+
+
+def member_cache_flags(name, intents):
+    if name == "none":
+        return discord.MemberCacheFlags.none()
+    if name == "joined":
+        flags = discord.MemberCacheFlags.none()
+        flags.joined = True
+        return flags
+    if name == "all":
+        return discord.MemberCacheFlags.from_intents(intents)
+    raise ValueError(f"MEMBER_CACHE must be none, joined or all, not {name!r}")
+
+
+def make_bot():
+    """A single-connection bot, or an auto-sharded one when SHARDS is "auto" or a shard count."""
+    intents = bot_intents()
+    options = dict(command_prefix='!', intents=intents, member_cache_flags=member_cache_flags(MEMBER_CACHE, intents),
+                   chunk_guilds_at_startup=CHUNK_GUILDS)
+    if not SHARDS:
+        return commands.Bot(**options)
+    return commands.AutoShardedBot(shard_count=None if SHARDS == "auto" else int(SHARDS), **options)
+
+
+bot = make_bot()
+METRICS.gauge("guilds", lambda: len(bot.guilds))
+METRICS.gauge("cached_members", lambda: sum(len(guild.members) for guild in bot.guilds))
+METRICS.gauge("shards", lambda: bot.shard_count or 1)
+
+
+def prewarm():
+    with METRICS.timer("prewarm"):
+        DETECTOR.get()
+        TRANSLITERATOR.words.get()
+        importlib.import_module("googleapiclient.discovery")
+        importlib.import_module("wiktionaryparser")
+
+
+def prewarmed(future):
+    if not future.cancelled() and future.exception():
+        log.error("prewarm failed", exc_info=future.exception())
+
+
+COMMAND_TREE_HASH = os.path.join(CACHE_DIR, "command_tree.sha256")
+
+
+def command_tree_hash():
+    definitions = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()),
+                       key=lambda command: (command["type"], command["name"]))
+    return hashlib.sha256(json.dumps(definitions, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+async def sync_commands():
+    """Syncs the global command tree only when its definition differs from the last synced one."""
+    fingerprint = command_tree_hash()
+    try:
+        with open(COMMAND_TREE_HASH, mode='r', encoding='utf-8') as file:
+            if file.read().strip() == fingerprint:
+                return
+    except OSError:
+        pass
+    await bot.tree.sync()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(COMMAND_TREE_HASH, mode='w', encoding='utf-8') as file:
+        file.write(fingerprint)
+    log.info("command tree synced", extra={"fields": {"hash": fingerprint[:12]}})
+
+
+@tasks.loop(seconds=5)
+async def watch_immersion():
+    if IMMERSION.reload():
+        refresh_detector()
+
+
+@tasks.loop(seconds=60)
+async def save_language_lookups():
+    unsaved = WIKTIONARY_LANGUAGES.unsaved_lookups()
+    if unsaved:
+        await asyncio.get_running_loop().run_in_executor(None, WIKTIONARY_CACHE.count_lookups, unsaved)
+
+
+LOOP_LAG = {"last": None, "seconds": 0.0}
+METRICS.gauge("event_loop_lag_seconds", lambda: LOOP_LAG["seconds"])
+
+
+@tasks.loop(seconds=1)
+async def watch_loop_lag():
+    now = time.perf_counter()
+    if LOOP_LAG["last"] is not None:
+        LOOP_LAG["seconds"] = max(0.0, now - LOOP_LAG["last"] - watch_loop_lag.seconds)
+        if LOOP_LAG["seconds"] > 0.5:
+            log.warning("event loop lag", extra={"fields": {"seconds": round(LOOP_LAG["seconds"], 3)}})
+    LOOP_LAG["last"] = now
+
+
+async def serve_metrics():
+    async def metrics(request):
+        return web.Response(text=METRICS.prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    except OSError as error:
+        await runner.cleanup()
+        log.error("metrics endpoint failed to start", extra={"fields": {"port": METRICS_PORT, "error": str(error)}})
+        return
+    log.info("metrics endpoint started", extra={"fields": {"port": METRICS_PORT}})
 
 
 @bot.event
 async def on_ready():
-    await bot.tree.sync()
+    if not watch_immersion.is_running():
+        watch_immersion.start()
+    if not save_language_lookups.is_running():
+        save_language_lookups.start()
+    if not watch_loop_lag.is_running():
+        watch_loop_lag.start()
+        if METRICS_PORT:
+            await serve_metrics()
+    asyncio.get_running_loop().run_in_executor(None, prewarm).add_done_callback(prewarmed)
+    for guild in bot.guilds:
+        channel = discord.utils.get(guild.channels, name="word-of-the-day")
+        if channel:
+            start_backfill(channel)
+    await sync_commands()
 
 
 @bot.event
 async def on_member_join(member: discord.Member):
-    channel = discord.utils.get(member.guild.channels, name="welcome")
+    channel = WELCOME_CHANNELS.get(member.guild)
     if channel:
-        message = f"<@{member.id}> {random.choice(WELCOME_MSGS)}"
-        await channel.send(message)
+        GREETER.join(channel, member.id)
+
+
+@bot.listen()
+async def on_guild_channel_create(channel):
+    WELCOME_CHANNELS.changed(channel)
+
+
+@bot.listen()
+async def on_guild_channel_update(before, after):
+    WELCOME_CHANNELS.changed(before, after)
+
+
+@bot.listen()
+async def on_guild_channel_delete(channel):
+    WELCOME_CHANNELS.changed(channel)
+
+
+@bot.listen()
+async def on_guild_remove(guild):
+    WELCOME_CHANNELS.forget(guild)
+    GREETER.joins.pop(guild.id, None)
 
 
 @bot.listen()
@@ -96,15 +2109,79 @@ async def on_message(message: discord.Message):
     channel = message.channel
     content = message.content
 
-    if not message.author.bot and channel.category_id in list(IMMERSION_CATEGORIES.keys()):
-        content = remove_pinyin(content) if channel.category_id == "1182926926160072746" else content
-        is_nonspacing = match_lang(content, ["zh-cn", "zh-tw", "zh", "jp", "ko"])
-        word_count = len(content) if is_nonspacing else len(content.split())
-        if word_count > 8:
-            allowed = match_lang(content, IMMERSION_CATEGORIES[channel.category_id]['allowed'])
-            reply = IMMERSION_CATEGORIES[channel.category_id]['reply']
-            if not allowed:
-                await channel.send(reply, reference=message)
+    policy = IMMERSION.get(channel.category_id)
+
+    if not message.author.bot and policy:
+        content = policy.prepare(content)
+        ruling = Ruling(text_digest(content), text_sketch(content))
+        RULINGS.put(message.id, ruling)
+        window = WINDOWS.add((message.author.id, channel.id), content, count_words(content, dominant_script(content)))
+        if window.words > policy.min_words:
+            if not await immersion_allowed(policy, window.take()):
+                warn(policy, message, ruling)
+
+
+async def immersion_allowed(policy, text):
+    script = dominant_script(text)
+    allowed = script_ruling(script, policy.allowed)
+    METRICS.count("immersion_rulings", by="detector" if allowed is None else "script")
+    if allowed is None:
+        allowed = await DETECTION.detect(text) in policy.allowed
+    return allowed
+
+
+def warn(policy, message, ruling):
+    def sent(reply):
+        ruling.warning = reply.id
+
+    METRICS.count("immersion_warnings")
+    OUTBOX.send(message.channel, PRIORITY_WARNING, key=(message.channel.id, message.author.id), sent=sent,
+                content=policy.reply, reference=message)
+
+
+@bot.listen()
+async def on_message_edit(before: discord.Message, after: discord.Message):
+    policy = IMMERSION.get(after.channel.category_id)
+    if after.author.bot or not policy:
+        return
+    content = policy.prepare(after.content)
+    digest = text_digest(content)
+    ruling = RULINGS.get(after.id)
+    if ruling is None:
+        previous = policy.prepare(before.content)
+        ruling = Ruling(text_digest(previous), text_sketch(previous))
+        RULINGS.put(after.id, ruling)
+    # Embed unfurls and small typo fixes keep the earlier ruling.
+    sketch = text_sketch(content)
+    if digest == ruling.digest or not text_changed(ruling.sketch, sketch):
+        METRICS.count("immersion_edits", outcome="unchanged")
+        return
+    ruling.digest, ruling.sketch = digest, sketch
+    allowed = True
+    if count_words(content, dominant_script(content)) > policy.min_words:
+        allowed = await immersion_allowed(policy, content)
+    METRICS.count("immersion_edits", outcome="checked")
+    if allowed:
+        # A warning still waiting in the outbox has no message to delete yet, so it is dropped from the queue.
+        if OUTBOX.cancel((after.channel.id, after.author.id)):
+            METRICS.count("immersion_warnings_withdrawn")
+        if ruling.warning:
+            warning, ruling.warning = ruling.warning, None
+            try:
+                await after.channel.get_partial_message(warning).delete()
+                METRICS.count("immersion_warnings_withdrawn")
+            except discord.HTTPException as error:
+                log.warning("warning removal failed", extra={"fields": {"message": warning, "error": str(error)}})
+    elif not ruling.warning:
+        warn(policy, after, ruling)
+
+
+@bot.listen()
+async def on_interaction(interaction: discord.Interaction):
+    # Autocomplete answers are not messages, so keystrokes in an option box don't spend the shared budget.
+    if interaction.type is discord.InteractionType.autocomplete:
+        return
+    OUTBOX.reserve()
 
 
 @bot.tree.command()
@@ -112,9 +2189,9 @@ async def on_message(message: discord.Message):
 # @discord.app_commands.checks.has_role("bot tester")
 async def convert(interaction, text: str):
     """Provides both conversions into simplified and traditional characters."""
-    is_chinese = match_lang(text, ["zh-cn", "zh-tw", "zh"])
+    is_chinese = await DETECTION.match(text, ["zh-cn", "zh-tw", "zh"])
     if is_chinese:
-        message = f"**简体：**{to_simplified(text)}\n**繁體：**{to_traditional(text)}"
+        message = f"**简体：**{CONVERTER.convert(text, 'simplified')}\n**繁體：**{CONVERTER.convert(text, 'traditional')}"
         await interaction.response.send_message(message, ephemeral=True)
     else:
         await interaction.response.send_message("Wrong language input.", ephemeral=True)
@@ -125,9 +2202,9 @@ async def convert(interaction, text: str):
 # @discord.app_commands.checks.has_role("bot tester")
 async def simplified(interaction, text: str):
     """Converts from traditional to simplified characters."""
-    is_chinese = match_lang(text, ["zh-cn", "zh-tw", "zh"])
+    is_chinese = await DETECTION.match(text, ["zh-cn", "zh-tw", "zh"])
     if is_chinese:
-        await interaction.response.send_message(to_simplified(text), ephemeral=True)
+        await interaction.response.send_message(CONVERTER.convert(text, 'simplified'), ephemeral=True)
     else:
         await interaction.response.send_message("Wrong language input.", ephemeral=True)
 
@@ -137,13 +2214,39 @@ async def simplified(interaction, text: str):
 # @discord.app_commands.checks.has_role("bot tester")
 async def traditional(interaction, text: str):
     """Converts from simplified to traditional characters."""
-    is_chinese = match_lang(text, ["zh-cn", "zh-tw", "zh"])
+    is_chinese = await DETECTION.match(text, ["zh-cn", "zh-tw", "zh"])
     if is_chinese:
-        await interaction.response.send_message(to_traditional(text), ephemeral=True)
+        await interaction.response.send_message(CONVERTER.convert(text, 'traditional'), ephemeral=True)
     else:
         await interaction.response.send_message("Wrong language input.", ephemeral=True)
 
 
+@bot.tree.command()
+@app_commands.choices(direction=[app_commands.Choice(name="Simplified characters.", value="simplified"),
+                                 app_commands.Choice(name="Traditional characters.", value="traditional")])
+@app_commands.describe(direction="Characters the text will be converted to.",
+                       file="UTF-8 .txt file, e.g. an article or subtitles.",
+                       text="Long Chinese text, used when no file is attached.")
+# @discord.app_commands.checks.has_role("bot tester")
+async def convert_file(interaction, direction: app_commands.Choice[str], file: discord.Attachment = None,
+                       text: str = None):
+    """Converts a whole text file between simplified and traditional characters."""
+    text = await read_long_text(interaction, file, text)
+    if text is None:
+        return
+    if not await DETECTION.match(text[:1000], ["zh-cn", "zh-tw", "zh"]):
+        await interaction.followup.send("Wrong language input.", ephemeral=True)
+        return
+
+    loop = asyncio.get_running_loop()
+    output = io.BytesIO()
+    for chunk in CONVERTER.chunks(text):
+        output.write((await loop.run_in_executor(None, CONVERTER.convert, chunk, direction.value)).encode("utf-8"))
+    output.seek(0)
+    await interaction.followup.send(file=discord.File(output, filename=output_name(file, direction.value)),
+                                    ephemeral=True)
+
+
 @bot.tree.command()
 @app_commands.choices(style=[app_commands.Choice(name="Diacritical tone marking.", value="diacritical"),
                              app_commands.Choice(name="Numerical tone marking.", value="numerical"),
@@ -153,21 +2256,85 @@ async def traditional(interaction, text: str):
 # @discord.app_commands.checks.has_role("bot tester")
 async def trans_zh(interaction, text: str, style: app_commands.Choice[str]):
     """Transliterates mandarin text using pinyin."""
-    is_chinese = match_lang(text, ["zh-cn", "zh-tw", "zh"])
-    if is_chinese:
-        await interaction.response.send_message(pinyin.get(text, format=style.value, delimiter=' '), ephemeral=True)
+    if HAN.search(text):
+        await interaction.response.send_message(TRANSLITERATOR.transliterate(text, style.value), ephemeral=True)
     else:
         await interaction.response.send_message("Wrong language input.", ephemeral=True)
 
 
+@bot.tree.context_menu(name="Transliterate to pinyin")
+async def trans_zh_message(interaction, message: discord.Message):
+    if not HAN.search(message.content):
+        await interaction.response.send_message("Wrong language input.", ephemeral=True)
+        return
+    await send_result(interaction, TRANSLITERATOR.transliterate(message.content), "pinyin.txt")
+
+
 @bot.tree.command()
-@app_commands.describe(text="Cyrillic text that will be transliterated.")
+@app_commands.choices(style=[app_commands.Choice(name="Diacritical tone marking.", value="diacritical"),
+                             app_commands.Choice(name="Numerical tone marking.", value="numerical"),
+                             app_commands.Choice(name="No tone marking.", value="strip")])
+@app_commands.describe(style="Pinyin format, default will show diacritics for tones.",
+                       file="UTF-8 .txt file with Chinese text, e.g. an article or subtitles.",
+                       text="Long Chinese text, used when no file is attached.")
 # @discord.app_commands.checks.has_role("bot tester")
-async def trans_cyrillic(interaction, text: str):
+async def trans_zh_file(interaction, style: app_commands.Choice[str], file: discord.Attachment = None,
+                        text: str = None):
+    """Transliterates a whole text file into pinyin."""
+    text = await read_long_text(interaction, file, text)
+    if text is None:
+        return
+    if not HAN.search(text):
+        await interaction.followup.send("Wrong language input.", ephemeral=True)
+        return
+
+    loop = asyncio.get_running_loop()
+    output = io.BytesIO()
+    for chunk in CONVERTER.chunks(text):
+        lines = await loop.run_in_executor(None, TRANSLITERATOR.transliterate_many, chunk.splitlines(True),
+                                           style.value)
+        output.write("".join(lines).encode("utf-8"))
+    output.seek(0)
+    await interaction.followup.send(file=discord.File(output, filename=output_name(file, "pinyin")), ephemeral=True)
+
+
+@bot.tree.command()
+@app_commands.choices(language=[app_commands.Choice(name="Russian", value="ru"),
+                                app_commands.Choice(name="Ukrainian", value="uk"),
+                                app_commands.Choice(name="Serbian", value="sr")],
+                      scheme=[app_commands.Choice(name="BGN/PCGN", value="bgn"),
+                              app_commands.Choice(name="Scientific", value="scientific"),
+                              app_commands.Choice(name="ISO 9", value="iso9")])
+@app_commands.describe(text="Cyrillic text that will be transliterated.",
+                       language="Language of the text, guessed from its letters by default.",
+                       scheme="Romanization to use, default is BGN/PCGN.")
+# @discord.app_commands.checks.has_role("bot tester")
+async def trans_cyrillic(interaction, text: str, language: app_commands.Choice[str] = None,
+                         scheme: app_commands.Choice[str] = None):
     """Transliterates cyrillic text into latin characters."""
-    is_cyrillic = bool(re.search('[а-яА-Я]', text))
-    if is_cyrillic:
-        await interaction.response.send_message(unidecode(text), ephemeral=True)
+    if script_histogram(text)["cyrillic"]:
+        language = language.value if language else cyrillic_language(text)
+        await send_result(interaction, romanize(text, language, scheme.value if scheme else "bgn"), "latin.txt")
+    else:
+        await interaction.response.send_message("Wrong input.", ephemeral=True)
+
+
+@bot.tree.command()
+@app_commands.describe(text="Greek text that will be transliterated.")
+async def trans_greek(interaction, text: str):
+    """Transliterates greek text into latin characters (ELOT 743)."""
+    if script_histogram(text)["greek"]:
+        await send_result(interaction, romanize(text, "el"), "latin.txt")
+    else:
+        await interaction.response.send_message("Wrong input.", ephemeral=True)
+
+
+@bot.tree.command()
+@app_commands.describe(text="Arabic text that will be transliterated.")
+async def trans_arabic(interaction, text: str):
+    """Transliterates arabic text into latin characters (DIN 31635)."""
+    if script_histogram(text)["arabic"]:
+        await send_result(interaction, romanize(text, "ar"), "latin.txt")
     else:
         await interaction.response.send_message("Wrong input.", ephemeral=True)
 
@@ -177,61 +2344,106 @@ async def trans_cyrillic(interaction, text: str):
 # @discord.app_commands.checks.has_role("bot tester")
 async def wiktionary(interaction, search: str, language: str):
     """Shows the first entry on Wiktionary (English) if it exists."""
-    parser = WiktionaryParser()
-    result = parser.fetch(search, language)
-    print(search, language, result)
-    result = result[0] if result else {}
-    if result and result["definitions"]:
-        ipa = "- " + "\n- ".join([n.replace("IPA: ", "") for n in result["pronunciations"]["text"] if "IPA" in n])
-        pos = result["definitions"][0]['partOfSpeech']
-        etymology = f">>> {result['etymology']}"
-        defs = "- " + "\n- ".join(result["definitions"][0]["text"][1:])
-        examples = "- " + "\n- ".join(result["definitions"][0]["examples"])
-
-        etymology = (etymology[:1020] + "...") if len(etymology) >= 1024 else etymology
-        defs = (defs[:1020] + "...") if len(defs) >= 1024 else defs
-        examples = (examples[:1020] + "...") if len(examples) >= 1024 else examples
-
-        gis = GoogleImagesSearch(GCS_DEVELOPER_KEY, GCS_CX)
-        img_params = {
-            "q": search,
-            'num': 1,
-            'fileType': 'jpg|gif|png',
-            'imgSize': 'large',
-            'rights': 'cc_publicdomain|cc_attribute|cc_sharealike|cc_noncommercial|cc_nonderived',
-        }
-
-        embed = discord.Embed(title=f"{search}",
-                              url=f"https://en.wiktionary.org/wiki/{search.lower()}#{language.title()}",
-                              color=discord.Color.blurple())
-        if len(ipa) > 2:
-            embed.add_field(name="Pronunciation", value=ipa)
-        if len(pos) > 0:
-            embed.add_field(name="Part of Speech", value=f"*{pos}*")
-        if len(etymology) > 4:
-            embed.add_field(name="Etymology", value=etymology, inline=False)
-        embed.add_field(name="Definitions", value=defs, inline=False)
-        if len(examples) > 2:
-            embed.add_field(name="Examples", value=examples, inline=False)
-        embed.set_footer(text=f"Wiktionary | {language.title()}")
-
-        try:
-            gis.search(search_params=img_params)
-            img_url = gis.results()[0].url
-            embed.set_thumbnail(url=img_url)
-            print(img_url)
-        except HttpError:
-            pass
-        except IndexError:
-            pass
-
-        await interaction.response.send_message(embed=embed)
+    name = WIKTIONARY_LANGUAGES.canonical(language)
+    if not name:
+        METRICS.count("wiktionary_unknown_language")
+        suggestions = WIKTIONARY_LANGUAGES.suggest(language)
+        hint = f" Did you mean {', '.join(suggestions)}?" if suggestions else ""
+        await interaction.response.send_message(f"Unknown language: {language}.{hint}", ephemeral=True)
+        return
+    language = name
+    WIKTIONARY_LANGUAGES.record(language)
+    await interaction.response.defer(thinking=True)
+    loop = asyncio.get_running_loop()
+    lookup = loop.run_in_executor(NETWORK, fetch_wiktionary, search, language)
+    thumbnail = loop.run_in_executor(IMAGES, search_image, search)
+    done, _ = await asyncio.wait({lookup, thumbnail}, timeout=LOOKUP_TIMEOUT)
+    result = finished(lookup, done) or []
+    img_url = finished(thumbnail, done)
+    log.info("wiktionary lookup", extra={"fields": {"search": search, "language": language, "found": bool(result)}})
+    pages = WiktionaryPages(search, language, result, img_url)
+    if pages:
+        if len(pages) > 1:
+            WIKTIONARY_SESSIONS.put(interaction.id, pages)
+            await interaction.followup.send(embed=pages.render(0), view=WiktionaryBrowser(interaction, len(pages)))
+        else:
+            await interaction.followup.send(embed=pages.render(0))
     else:
         embed = discord.Embed(title=f"{search}",
                               url=f"https://en.wiktionary.org/wiki/{search.lower()}",
                               color=discord.Color.blurple(),
-                              description=f"An entry for this word in {language.title()} could not be fetched, click on the link to go to Wiktionary.")
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+                              description=f"An entry for this word in {language} could not be fetched, click on the link to go to Wiktionary.")
+        await interaction.delete_original_response()
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+
+@wiktionary.autocomplete("language")
+async def wiktionary_language(interaction, current: str):
+    with METRICS.timer("wiktionary_autocomplete"):
+        return [app_commands.Choice(name=name, value=name) for name in WIKTIONARY_LANGUAGES.complete(current)]
+
+
+@bot.tree.command()
+@app_commands.checks.has_role(STAFF_ROLE)
+async def botstats(interaction):
+    """Shows timings, cache hit rates and queue depths of the bot's hot paths."""
+    counters, timings, gauges = METRICS.snapshot()
+    embed = discord.Embed(title="Bot stats", color=discord.Color.blurple())
+    if timings:
+        embed.add_field(name="Timings", inline=False, value="\n".join(
+            f"**{name}**: {count} × {total / count * 1e3:.1f} ms avg, {longest * 1e3:.0f} ms max"
+            for name, (count, total, longest) in sorted(timings.items()))[:1024])
+    if counters:
+        embed.add_field(name="Counters", inline=False, value="\n".join(
+            f"**{' '.join([name, *(value for _, value in labels)])}**: {count}"
+            for (name, labels), count in sorted(counters.items()))[:1024])
+    embed.add_field(name="Gauges", inline=False, value="\n".join(
+        f"**{name}**: {round(value, 3)}" for name, value in sorted(gauges.items()))[:1024])
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@bot.tree.command()
+@app_commands.checks.has_role(STAFF_ROLE)
+@app_commands.describe(channel="Channel in an immersion category to audit.",
+                       min_words="Ignore messages with this many words or fewer. Default is the category's setting.")
+async def immersion_audit(interaction, channel: discord.TextChannel, min_words: int = None):
+    """Audits a channel's history against its immersion policy, continuing from the previous audit."""
+
+    policy = IMMERSION.get(channel.category_id)
+    if not policy:
+        await interaction.response.send_message("That channel is not in an immersion category.", ephemeral=True)
+        return
+    if channel.id in AUDITING:
+        await interaction.response.send_message("That channel is already being audited.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    AUDITING.add(channel.id)
+    try:
+        with METRICS.timer("immersion_audit"):
+            # Interaction tokens expire after 15 minutes; stop in time to report and let the next run resume.
+            stats, audited, finished = await audit_channel(channel, policy, policy.min_words if min_words is None
+                                                           else min_words, time.monotonic() + 13 * 60)
+    except discord.HTTPException as error:
+        log.warning("immersion audit failed", extra={"fields": {"channel": channel.id, "error": str(error)}})
+        await interaction.followup.send(f"The audit stopped: {error}. Progress so far was saved.", ephemeral=True)
+        return
+    finally:
+        AUDITING.discard(channel.id)
+    if not stats["checked"]:
+        await interaction.followup.send(f"Audited {audited} new messages, none long enough to judge.", ephemeral=True)
+        return
+    users, languages = audit_report(stats)
+    embed = discord.Embed(title=f"Immersion audit: #{channel.name}", color=discord.Color.blurple())
+    embed.add_field(name="Messages", value=f"{stats['messages']} ({audited} new), {stats['checked']} judged")
+    embed.add_field(name="Compliance", value=f"{stats['compliant'] / stats['checked']:.1%}")
+    embed.add_field(name="Languages", inline=False, value=", ".join(
+        f"{language} {count / stats['checked']:.1%}"
+        for language, count in sorted(stats["languages"].items(), key=lambda item: -item[1])[:10]))
+    if not finished:
+        embed.set_footer(text="Stopped before the end of the history, run the audit again to continue.")
+    await interaction.followup.send(embed=embed, ephemeral=True, files=[
+        discord.File(io.BytesIO(users.encode("utf-8")), filename=f"audit-{channel.id}-users.csv"),
+        discord.File(io.BytesIO(languages.encode("utf-8")), filename=f"audit-{channel.id}-languages.csv")])
 
 
 @bot.tree.command()
@@ -268,9 +2480,52 @@ async def wod(interaction, language: app_commands.Choice[str], word: str, defini
         if validators.url(image):
             embed.set_image(url=image)
 
-        await channel.send(embed=embed)
+        message = await channel.send(embed=embed)
+        WOD_ARCHIVE.put({"message_id": message.id, "guild_id": channel.guild.id, "channel_id": channel.id,
+                         "language": language.value, "word": word, "definition": definition, "example": example,
+                         "ipa": ipa, "etymology": etymology, "author": interaction.user.display_name, "date": today})
         if ping.value:
             await channel.send(content="<@&1183618548048875582>")
         await interaction.response.send_message("👍✅", ephemeral=True)
 
-bot.run(BOT_TOKEN)
+
+@bot.tree.command()
+@app_commands.choices(language=LANGS, mode=[app_commands.Choice(name="Words and definitions", value="text"),
+                                            app_commands.Choice(name="Word prefix", value="prefix")])
+@app_commands.describe(query="Words to look for.",
+                       language="Only search words of the day in this language.",
+                       mode="Match all words of the query, or words starting with it. Default is the former.")
+async def wod_search(interaction, query: str, language: app_commands.Choice[str] = None,
+                     mode: app_commands.Choice[str] = None):
+    """Searches past words of the day."""
+
+    prefix = bool(mode and mode.value == "prefix")
+    with METRICS.timer("wod_search"):
+        posts = WOD_ARCHIVE.search(query, language.value if language else None, prefix=prefix)
+    if not posts:
+        await interaction.response.send_message("No words of the day found.", ephemeral=True)
+        return
+    lines = []
+    for post in posts:
+        link = f"https://discord.com/channels/{post['guild_id']}/{post['channel_id']}/{post['message_id']}"
+        name = WOD.get(post["language"], {}).get("name", post["language"])
+        definition = post["definition"] or ""
+        lines.append(f"[**{post['word']}**]({link}) | {name} | {post['date']}\n"
+                     f"{definition[:150] + '…' if len(definition) > 150 else definition}")
+    embed = discord.Embed(title=query, description="\n\n".join(lines)[:4096], color=discord.Color.blurple())
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["prewarm"]:
+        for dump in sys.argv[2:]:
+            print(f"{dump}: {prewarm_wiktionary(dump)} entries cached")
+    elif sys.argv[1:2] == ["update-languages"]:
+        # Source: Wiktionary's csv format list of languages, or a saved copy of it given as the argument.
+        print(f"{WIKTIONARY_LANGUAGES_PATH}: {update_wiktionary_languages(*sys.argv[2:3])} languages")
+    elif sys.argv[1:2] == ["build-index"]:
+        entries = [entry for dump in sys.argv[2:] for entry in read_dump(dump)]
+        print(f"{WIKTIONARY_INDEX_PATH}: {WiktionaryIndex.build(entries, WIKTIONARY_INDEX_PATH)} entries indexed")
+    else:
+        setup_logging()
+        bot.run(BOT_TOKEN, log_handler=None)